@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""
+Build fingerprinted, minified and precompressed static assets
+
+Reads the css, js and img directories in static/, and writes to
+static/build/:
+
+ - a minified copy of each asset, named with a hash of its content
+   (foo.css becomes foo.<hash>.css), so that it can be served with
+   far-future, immutable caching
+ - .gz (and, if the brotli module is installed, .br) variants of each
+   text asset, for serving with Content-Encoding
+ - manifest.json, mapping original filenames (as passed to
+   url_for('static', filename=...)) to built filenames
+
+It also transcodes the IVR prompts in static/audio to 8 kHz mono mu-law
+WAV (what Twilio plays down the phone anyway), trimming leading and
+trailing silence and checking each prompt's duration and loudness. These
+are fingerprinted and added to the manifest in the same way.
+
+notam.static_url consults the manifest. Run this after changing anything
+in static/, and before (re)starting uWSGI.
+"""
+
+import os
+import re
+import math
+import sys
+import json
+import gzip
+import wave
+import struct
+import audioop
+import hashlib
+import argparse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+root = os.path.dirname(os.path.abspath(__file__))
+static_dir = os.path.join(root, "static")
+default_build_dir = os.path.join(static_dir, "build")
+
+asset_dirs = ("img", "css", "js")  # images first: css refers to them
+compress_exts = (".css", ".js", ".svg")
+hash_length = 12
+
+audio_dir = "audio"
+audio_rate = 8000
+audio_silence_threshold = 500   # of 32767; below this counts as silence
+audio_silence_keep = 0.1        # seconds of silence to leave either end
+audio_duration_range = (0.5, 20.0)
+audio_loudness_range = (-35.0, -10.0)   # RMS, dBFS
+
+class BuildError(Exception):
+    """An asset failed validation"""
+    pass
+
+_css_comment_re = re.compile(r'/\*.*?\*/', re.S)
+_css_space_re = re.compile(r'\s+')
+_css_punct_re = re.compile(r'\s*([{};,>])\s*')
+_css_colon_re = re.compile(r':\s+')
+_css_url_re = re.compile(r'url\((["\']?)([^)"\']+)\1\)')
+
+def minify_css(text):
+    """Very conservative CSS minifier: comments and whitespace only"""
+    text = _css_comment_re.sub('', text)
+    text = _css_space_re.sub(' ', text)
+    text = _css_punct_re.sub(r'\1', text)
+    # not spaces before colons: "a :hover" differs from "a:hover"
+    text = _css_colon_re.sub(':', text)
+    return text.replace(';}', '}').strip()
+
+def fingerprint(filename, content):
+    """Insert a hash of content before filename's extension"""
+    base, ext = os.path.splitext(filename)
+    digest = hashlib.sha1(content).hexdigest()[:hash_length]
+    return "{0}.{1}{2}".format(base, digest, ext)
+
+def min_sibling(filename):
+    """Return the .min. version of filename, if it is a source file"""
+    base, ext = os.path.splitext(filename)
+    if base.endswith(".min"):
+        return None
+    return base + ".min" + ext
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def write(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, "wb") as f:
+        f.write(content)
+
+def write_compressed(path, content):
+    """Write path.gz and path.br (the latter only if brotli is available)"""
+    with open(path + ".gz", "wb") as raw:
+        # mtime=0 so that rebuilding identical input is byte-identical
+        gz = gzip.GzipFile(filename="", mode="wb", fileobj=raw,
+                           compresslevel=9, mtime=0)
+        gz.write(content)
+        gz.close()
+
+    if brotli is not None:
+        write(path + ".br", brotli.compress(content))
+
+def rewrite_css_urls(css_filename, text, manifest):
+    """Point url(...)s in a CSS file at the fingerprinted assets"""
+
+    css_dir = os.path.dirname(css_filename)
+
+    def replace(match):
+        quote, url = match.groups()
+        if ":" in url or url.startswith("/"):
+            return match.group(0)
+        target = os.path.normpath(os.path.join(css_dir, url))
+        target = target.replace(os.sep, "/")
+        if target not in manifest:
+            return match.group(0)
+        new_url = os.path.relpath(manifest[target], css_dir or ".")
+        return "url({0}{1}{0})".format(quote, new_url.replace(os.sep, "/"))
+
+    return _css_url_re.sub(replace, text)
+
+def build_asset(filename, manifest, build_dir):
+    """Minify, fingerprint and compress one asset, adding it to manifest"""
+
+    path = os.path.join(static_dir, filename)
+    sibling = min_sibling(filename)
+
+    if sibling and os.path.exists(os.path.join(static_dir, sibling)):
+        # already have a minified version (bootstrap, jquery)
+        content = read(os.path.join(static_dir, sibling))
+    else:
+        content = read(path)
+        if filename.endswith(".css") and not filename.endswith(".min.css"):
+            content = minify_css(content.decode("utf-8")).encode("utf-8")
+
+    if filename.endswith(".css"):
+        text = rewrite_css_urls(filename, content.decode("utf-8"), manifest)
+        content = text.encode("utf-8")
+
+    built = fingerprint(filename, content)
+    built_path = os.path.join(build_dir, built)
+    write(built_path, content)
+    if filename.endswith(compress_exts):
+        write_compressed(built_path, content)
+
+    manifest[filename] = built
+    return built
+
+def read_pcm(path):
+    """Read a WAV file as 16-bit mono PCM at audio_rate"""
+
+    w = wave.open(path, "rb")
+    try:
+        channels, width, rate, frames = w.getparams()[:4]
+        pcm = w.readframes(frames)
+    finally:
+        w.close()
+
+    if width != 2:
+        pcm = audioop.lin2lin(pcm, width, 2)
+    if channels == 2:
+        pcm = audioop.tomono(pcm, 2, 0.5, 0.5)
+    elif channels != 1:
+        raise BuildError("{0}: {1} channels".format(path, channels))
+    if rate != audio_rate:
+        pcm, _ = audioop.ratecv(pcm, 2, 1, rate, audio_rate, None)
+
+    return pcm
+
+def trim_silence(pcm):
+    """Strip silence from either end of 16-bit mono PCM, keeping a little"""
+
+    step = audio_rate // 100    # 10ms windows
+    windows = [i for i in range(0, len(pcm) // 2, step)
+               if audioop.max(pcm[i * 2:(i + step) * 2], 2) >
+                  audio_silence_threshold]
+    if not windows:
+        return pcm
+
+    keep = int(audio_silence_keep * audio_rate)
+    start = max(windows[0] - keep, 0)
+    end = min(windows[-1] + step + keep, len(pcm) // 2)
+    return pcm[start * 2:end * 2]
+
+def check_prompt(filename, pcm):
+    """Raise BuildError if a prompt's duration or loudness is out of range"""
+
+    duration = len(pcm) / 2.0 / audio_rate
+    low, high = audio_duration_range
+    if not low <= duration <= high:
+        raise BuildError("{0}: duration {1:.2f}s not in [{2}, {3}]"
+                         .format(filename, duration, low, high))
+
+    rms = audioop.rms(pcm, 2)
+    loudness = 20 * math.log10(max(rms, 1) / 32768.0)
+    low, high = audio_loudness_range
+    if not low <= loudness <= high:
+        raise BuildError("{0}: loudness {1:.1f} dBFS not in [{2}, {3}]"
+                         .format(filename, loudness, low, high))
+
+    return duration, loudness
+
+def ulaw_wav(pcm):
+    """Encode 16-bit mono PCM as a mu-law WAV file (format tag 7)"""
+
+    data = audioop.lin2ulaw(pcm, 2)
+    frames = len(data)
+    fmt = struct.pack("<HHIIHHH", 7, 1, audio_rate, audio_rate, 1, 8, 0)
+    fact = struct.pack("<I", frames)
+    chunks = [(b"fmt ", fmt), (b"fact", fact), (b"data", data)]
+
+    body = b"WAVE"
+    for name, chunk in chunks:
+        body += name + struct.pack("<I", len(chunk)) + chunk
+        if len(chunk) % 2:
+            body += b"\0"
+
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+def build_prompt(filename, manifest, build_dir):
+    """Transcode, check and fingerprint one IVR prompt"""
+
+    pcm = trim_silence(read_pcm(os.path.join(static_dir, filename)))
+    duration, loudness = check_prompt(filename, pcm)
+    content = ulaw_wav(pcm)
+
+    built = fingerprint(filename, content)
+    write(os.path.join(build_dir, built), content)
+    manifest[filename] = built
+    return built, duration, loudness
+
+def prompt_filenames():
+    """Yield static-relative filenames of every IVR prompt"""
+    directory = os.path.join(static_dir, audio_dir)
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".wav"):
+            yield audio_dir + "/" + name
+
+def asset_filenames():
+    """Yield static-relative filenames of every asset, images first"""
+    for directory in asset_dirs:
+        for name in sorted(os.listdir(os.path.join(static_dir, directory))):
+            if os.path.isfile(os.path.join(static_dir, directory, name)):
+                yield directory + "/" + name
+
+def load_manifest(build_dir):
+    try:
+        with open(os.path.join(build_dir, "manifest.json")) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(build_dir, manifest):
+    with open(os.path.join(build_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+        f.write("\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--build-dir", default=default_build_dir)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest(args.build_dir)
+
+    for filename in asset_filenames():
+        built = build_asset(filename, manifest, args.build_dir)
+        if args.verbose:
+            print("{0} -> {1}".format(filename, built))
+
+    try:
+        for filename in prompt_filenames():
+            built, duration, loudness = \
+                    build_prompt(filename, manifest, args.build_dir)
+            if args.verbose:
+                print("{0} -> {1} ({2:.2f}s, {3:.1f} dBFS)"
+                      .format(filename, built, duration, loudness))
+    except BuildError as e:
+        sys.exit("audio check failed: {0}".format(e))
+
+    save_manifest(args.build_dir, manifest)
+
+    if brotli is None:
+        sys.stderr.write("brotli not installed: only wrote .gz variants\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+Save and restore humans, messages and call history with COPY
+
+For moving data between databases (e.g., production to staging, for load
+tests) or restoring after a disaster, without pg_dump-ing everything.
+
+    data_snapshot.py save DSN DIRECTORY [--since T] [--until T]
+    data_snapshot.py restore DSN DIRECTORY
+
+save writes, from one consistent (REPEATABLE READ) view of the database,
+a gzipped COPY file per table and DIRECTORY/manifest.json:
+
+ - lines, humans_roster, humans and human_availability, in full
+ - messages active at any time in [--since, --until)
+ - calls with a call log line in [--since, --until), and all of their
+   call_log and human_dials rows
+
+restore loads a snapshot into a database created with schema.sql,
+replacing what is there: it TRUNCATEs those tables (and, by CASCADE,
+anything referring to them, like active_calls and call_reports) in the
+same transaction. Rows are streamed in both directions, so neither needs
+to fit in memory. The messages_past_* triggers would refuse to restore
+messages in the past if run as www-data, and lines_add_roster would add
+roster rows that the snapshot already has, so restore runs as a table
+owner and disables those triggers for its transaction. Workers are told
+to drop their caches (CACHE_NOTIFY) when it commits.
+
+Unrelated to degraded mode's SNAPSHOT_DIR.
+"""
+
+import os
+import sys
+import json
+import gzip
+import argparse
+import datetime
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
+
+manifest_name = "manifest.json"
+manifest_format = 1
+copy_chunk_size = 64 * 1024
+
+# in foreign key order. Each selects the rows to save, given since and until
+_sliced_calls = \
+        "SELECT c.id FROM calls AS c WHERE EXISTS " \
+        "(SELECT 1 FROM call_log AS l WHERE l.call = c.id AND " \
+        "(%(since)s::TIMESTAMP IS NULL OR l.time >= %(since)s::TIMESTAMP) " \
+        "AND " \
+        "(%(until)s::TIMESTAMP IS NULL OR l.time < %(until)s::TIMESTAMP))"
+
+tables = [
+    ("lines", "SELECT {0} FROM lines"),
+    ("humans_roster", "SELECT {0} FROM humans_roster"),
+    ("humans", "SELECT {0} FROM humans"),
+    ("human_availability", "SELECT {0} FROM human_availability"),
+    ("messages",
+        "SELECT {0} FROM messages WHERE active_when && "
+        "TSRANGE(%(since)s::TIMESTAMP, %(until)s::TIMESTAMP)"),
+    ("calls", "SELECT {0} FROM calls WHERE id IN (" + _sliced_calls + ")"),
+    ("call_log",
+        "SELECT {0} FROM call_log WHERE call IN (" + _sliced_calls + ") OR "
+        "(call IS NULL AND "
+        "(%(since)s::TIMESTAMP IS NULL OR time >= %(since)s::TIMESTAMP) AND "
+        "(%(until)s::TIMESTAMP IS NULL OR time < %(until)s::TIMESTAMP))"),
+    ("human_dials",
+        "SELECT {0} FROM human_dials WHERE call IN (" + _sliced_calls + ")"),
+]
+
+# disabled while restoring; see above
+restore_disabled_triggers = [
+    ("messages", "messages_past_insert_trigger"),
+    ("lines", "lines_add_roster_trigger"),
+]
+
+class SnapshotError(Exception):
+    pass
+
+def table_columns(cur, table):
+    cur.execute("SELECT * FROM {0} LIMIT 0".format(table))
+    return [column[0] for column in cur.description]
+
+def save(conn, directory, since=None, until=None, verbose=False):
+    """Write a snapshot of the database to directory"""
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    conn.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ,
+                     readonly=True)
+
+    params = {"since": since, "until": until}
+    manifest = {"format": manifest_format, "since": since, "until": until,
+                "tables": []}
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT LOCALTIMESTAMP")
+        manifest["written"] = cur.fetchone()[0].isoformat()
+
+        for table, query in tables:
+            columns = table_columns(cur, table)
+            query = query.format(", ".join(columns))
+            copy = "COPY ({0}) TO STDOUT" \
+                    .format(cur.mogrify(query, params).decode("utf-8"))
+
+            filename = table + ".copy.gz"
+            with gzip.open(os.path.join(directory, filename), "wb") as f:
+                cur.copy_expert(copy, f, size=copy_chunk_size)
+
+            manifest["tables"].append({"name": table, "columns": columns,
+                                       "file": filename,
+                                       "rows": cur.rowcount})
+            if verbose:
+                print("{0}: {1} rows".format(table, cur.rowcount))
+
+    conn.rollback()
+
+    # last, so that a partial snapshot can't be restored
+    with open(os.path.join(directory, manifest_name), "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+        f.write("\n")
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, manifest_name)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError) as e:
+        raise SnapshotError("can't read {0}: {1}".format(manifest_name, e))
+
+    if manifest.get("format") != manifest_format:
+        raise SnapshotError("unknown snapshot format {0!r}"
+                            .format(manifest.get("format")))
+
+    known = [table for table, query in tables]
+    for entry in manifest["tables"]:
+        if entry["name"] not in known:
+            raise SnapshotError("unexpected table {0!r}"
+                                .format(entry["name"]))
+
+    return manifest
+
+def reset_sequence(cur, table, columns):
+    """Point table's id sequence (if it has one) past the restored rows"""
+
+    if "id" not in columns:
+        return
+
+    cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table, ))
+    sequence = cur.fetchone()[0]
+    if sequence is None:
+        return
+
+    cur.execute("SELECT setval(%s, COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) "
+                "FROM {0}".format(table), (sequence, ))
+
+def restore(conn, directory, verbose=False):
+    """Replace the database's contents with the snapshot in directory"""
+
+    manifest = load_manifest(directory)
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT CURRENT_USER")
+        if cur.fetchone()[0] == "www-data":
+            raise SnapshotError("restore as a table owner, not www-data")
+
+        for table, trigger in restore_disabled_triggers:
+            cur.execute("ALTER TABLE {0} DISABLE TRIGGER {1}"
+                        .format(table, trigger))
+
+        names = [entry["name"] for entry in manifest["tables"]]
+        cur.execute("TRUNCATE {0} RESTART IDENTITY CASCADE"
+                    .format(", ".join(names)))
+
+        for entry in manifest["tables"]:
+            copy = "COPY {0} ({1}) FROM STDIN" \
+                    .format(entry["name"], ", ".join(entry["columns"]))
+            with gzip.open(os.path.join(directory, entry["file"]), "rb") as f:
+                cur.copy_expert(copy, f, size=copy_chunk_size)
+            if verbose:
+                print("{0}: {1} rows".format(entry["name"], cur.rowcount))
+
+            reset_sequence(cur, entry["name"], entry["columns"])
+
+        for table, trigger in restore_disabled_triggers:
+            cur.execute("ALTER TABLE {0} ENABLE TRIGGER {1}"
+                        .format(table, trigger))
+
+    conn.commit()
+
+def timestamp(value):
+    """argparse type: 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'"""
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(value, fmt).isoformat(" ")
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("bad timestamp {0!r}".format(value))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    save_parser = subparsers.add_parser("save")
+    save_parser.add_argument("dsn")
+    save_parser.add_argument("directory")
+    save_parser.add_argument("--since", type=timestamp,
+                             help="only messages and calls since (local time)")
+    save_parser.add_argument("--until", type=timestamp,
+                             help="only messages and calls before")
+
+    restore_parser = subparsers.add_parser("restore")
+    restore_parser.add_argument("dsn")
+    restore_parser.add_argument("directory")
+
+    for p in (save_parser, restore_parser):
+        p.add_argument("-v", "--verbose", action="store_true")
+
+    args = parser.parse_args(argv)
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        if args.command == "save":
+            save(conn, args.directory, args.since, args.until, args.verbose)
+        else:
+            restore(conn, args.directory, args.verbose)
+    except (SnapshotError, psycopg2.Error) as e:
+        sys.exit("{0} failed: {1}".format(args.command, e))
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,44 @@
+import time
+_import_started = time.time()
+
 import flask
 from twilio import twiml
 import twilio.util
 import logging
 import smtplib
-import time
+import os
+import json
+import glob
+import errno
+import select
+import socket
+import mmap
+import fcntl
+import hashlib
+import struct
+import functools
+import threading
+import itertools
+import collections
+import contextlib
+import mimetypes
 import re
 import random
+import math
 import datetime
 import raven.flask_glue
+import jinja2
 import psycopg2
 import psycopg2.errorcodes
-from psycopg2.extras import DateTimeRange, RealDictCursor
+import psycopg2.extensions
+from psycopg2.extras import DateTimeRange, RealDictCursor, execute_values
 
 from flask import request, url_for, redirect, render_template, \
                   Markup, jsonify, abort, flash, session, g
 
+# (reported by warm_up)
+_import_seconds = time.time() - _import_started
+
 app = flask.Flask(__name__)
 
 
@@ -22,18 +46,43 @@ app = flask.Flask(__name__)
 
 twilio_validator = None
 raven_decorator = None
+_setup_lock = threading.Lock()
 
-@app.before_first_request
+# Requests may be served concurrently, by uWSGI threads or gevent
+# greenlets (see make_psycopg2_green). In-process caches and buffers
+# shared between requests are modified under _state_lock.
+_state_lock = threading.Lock()
+
+@app.before_request
 def setup_configured_globals():
-    """Creates the Twilio RequestValidator and the raven AuthDecorator"""
+    """
+    Creates the Twilio RequestValidator and the raven AuthDecorator, and
+    sets up the template bytecode cache (JINJA_CACHE_DIR)
+
+    Only the first call (per process) does anything; concurrent first
+    requests wait for it.
+    """
 
     global twilio_validator, raven_decorator
 
-    twilio_validator = \
-            twilio.util.RequestValidator(app.config["TWILIO_AUTH_TOKEN"])
-    raven_decorator = \
-            raven.flask_glue.AuthDecorator(
-                    require_principal=app.config["ADMIN_CRSIDS"])
+    if twilio_validator is not None:
+        return
+
+    with _setup_lock:
+        if twilio_validator is not None:
+            return
+
+        raven_decorator = \
+                raven.flask_glue.AuthDecorator(
+                        require_principal=app.config["ADMIN_CRSIDS"])
+        cache_dir = app.config.get("JINJA_CACHE_DIR")
+        if cache_dir:
+            # before any template is compiled
+            app.jinja_env.bytecode_cache = \
+                    jinja2.FileSystemBytecodeCache(cache_dir)
+        # last: other threads check it without the lock
+        twilio_validator = \
+                twilio.util.RequestValidator(app.config["TWILIO_AUTH_TOKEN"])
 
 
 ## PostgreSQL
@@ -47,14 +96,210 @@ def connection():
     get the same connection.
 
     The connection is committed and closed at the end of the request.
+    In journal mode (CALL_LOG_JOURNAL_DIR), Twilio requests commit without
+    waiting for PostgreSQL to flush the commit to disk (see
+    close_db_connection).
     """
 
     assert flask.has_request_context()
     if not hasattr(g, '_database'):
-        g._database = psycopg2.connect(app.config["POSTGRES"])
+        pool = connection_pool("POSTGRES")
+        if pool is None:
+            g._database = psycopg2.connect(app.config["POSTGRES"],
+                                           **connection_budget())
+        else:
+            budget = connection_budget()
+            budget.pop("options", None)
+            g._database = pool.getconn(**budget)
+            if snapshot_enabled():
+                # pooled connections outlive this request's budget
+                with g._database.cursor() as cur:
+                    cur.execute("SET statement_timeout = %s",
+                                (statement_budget() or 0, ))
+        g._asynchronous_commit = call_log_journal.enabled() and \
+                (request.endpoint or "").startswith("twilio_")
     return g._database
 
-def cursor(real_dict_cursor=False):
+def connection_budget():
+    """
+    Extra psycopg2.connect arguments limiting how long Twilio waits on us
+
+    If degraded mode is enabled (SNAPSHOT_DIR), Twilio requests give up on
+    PostgreSQL after POSTGRES_TWILIO_BUDGET milliseconds (default 2000)
+    to connect or per statement, and are answered from the snapshot.
+    """
+
+    budget = statement_budget()
+    if budget is None:
+        return {}
+
+    return {"connect_timeout": max(1, int(math.ceil(budget / 1000.0))),
+            "options": "-c statement_timeout={0}".format(budget)}
+
+def statement_budget():
+    """The budget in milliseconds for this request, if it has one"""
+
+    if not snapshot_enabled() or \
+            not (request.endpoint or "").startswith("twilio_"):
+        return None
+
+    return app.config.get("POSTGRES_TWILIO_BUDGET", 2000)
+
+def discard_db_connections():
+    """Close (without committing) this request's connections, if any"""
+
+    for attr, setting in (('_database', "POSTGRES"),
+                          ('_read_database', "POSTGRES_READ")):
+        if hasattr(g, attr):
+            conn = getattr(g, attr)
+            delattr(g, attr)
+            release_connection(setting, conn, close=True)
+
+    # (closing the connection released it)
+    if hasattr(g, "_webhook_lock"):
+        del g._webhook_lock
+
+def release_connection(setting, conn, close=False):
+    """Return conn to its pool, or close it if not pooled (or if close)"""
+
+    pool = connection_pool(setting)
+    if pool is not None:
+        pool.putconn(conn, close=close)
+    else:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+class ConnectionPool(object):
+    """
+    A thread-safe (and, monkey patched, greenlet-safe) connection pool
+
+    At most size connections are open at once; getconn() waits for a
+    free one. Connections are returned to the pool only if idle, so a
+    request's transaction never leaks into the next.
+    """
+
+    def __init__(self, dsn, size):
+        self.dsn = dsn
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def getconn(self, **kwargs):
+        """Get a connection; kwargs are used if a new one is needed"""
+
+        self.slots.acquire()
+        try:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(self.dsn, **kwargs)
+            return conn
+        except:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        try:
+            idle = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            if close or conn.closed or \
+                    conn.get_transaction_status() != idle:
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            else:
+                with self.lock:
+                    self.idle.append(conn)
+        finally:
+            self.slots.release()
+
+_pools = {}
+
+def connection_pool(setting):
+    """
+    Get this process's pool for the app.config[setting] DSN, or None
+
+    Pooling is enabled by POSTGRES_POOL, the maximum number of
+    connections per process (per DSN) - at least as many as the threads
+    or greenlets serving requests, or they will wait for each other.
+    """
+
+    size = app.config.get("POSTGRES_POOL")
+    if not size:
+        return None
+
+    # a pool's connections must not be shared with a forked child
+    key = (os.getpid(), setting)
+    pool = _pools.get(key)
+    if pool is None:
+        with _state_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = \
+                        ConnectionPool(app.config[setting], size)
+    return pool
+
+def make_psycopg2_green():
+    """
+    Have psycopg2 yield to other greenlets while waiting for PostgreSQL
+
+    Call this once, after gevent's monkey patching (e.g., from notam.wsgi
+    when running under uWSGI's gevent loop). Note that COPY is then
+    unavailable.
+    """
+
+    import gevent.socket
+
+    def wait_callback(conn, timeout=None):
+        while True:
+            state = conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                break
+            elif state == psycopg2.extensions.POLL_READ:
+                gevent.socket.wait_read(conn.fileno(), timeout=timeout)
+            elif state == psycopg2.extensions.POLL_WRITE:
+                gevent.socket.wait_write(conn.fileno(), timeout=timeout)
+            else:
+                raise psycopg2.OperationalError(
+                        "Bad result from poll: {0!r}".format(state))
+
+    psycopg2.extensions.set_wait_callback(wait_callback)
+
+def read_connection():
+    """
+    Get a connection to use for read-only queries in this request
+
+    If POSTGRES_READ (e.g., a streaming replica) is configured, reads go
+    there, except:
+
+     - if this request has already used the primary connection(), reads
+       use it too, so they see the request's own writes;
+     - for a short while (POSTGRES_READ_STICKY seconds, default 10) after
+       an admin request that wrote to the primary, so that the admin's
+       session reads its own writes despite replication lag.
+
+    Otherwise, this is the same as connection().
+    """
+
+    assert flask.has_request_context()
+
+    if hasattr(g, '_database') or not app.config.get("POSTGRES_READ") or \
+            session.get("_read_primary_until", 0) > time.time():
+        return connection()
+
+    if not hasattr(g, '_read_database'):
+        pool = connection_pool("POSTGRES_READ")
+        if pool is None:
+            g._read_database = psycopg2.connect(app.config["POSTGRES_READ"])
+        else:
+            g._read_database = pool.getconn()
+        if not g._read_database.autocommit:
+            g._read_database.set_session(readonly=True, autocommit=True)
+    return g._read_database
+
+def cursor(real_dict_cursor=False, read_only=False):
     """
     Get a postgres cursor for immediate use during a request
 
@@ -63,24 +308,294 @@ def cursor(real_dict_cursor=False):
 
     The connection is committed and closed at the end of the request.
 
-    If real_dict_cursor is set, a RealDictCursor is returned
+    If real_dict_cursor is set, a RealDictCursor is returned.
+    If read_only is set, the cursor may come from read_connection().
     """
 
+    conn = read_connection() if read_only else connection()
+
     if real_dict_cursor:
         f = RealDictCursor
-        return connection().cursor(cursor_factory=f)
+        return conn.cursor(cursor_factory=f)
     else:
-        return connection().cursor()
+        return conn.cursor()
+
+@contextlib.contextmanager
+def separate_connection():
+    """
+    Get a connection outside this request's transaction
+
+    For writes (e.g., from after_request hooks) that mustn't roll back,
+    or commit early, the view's own. It is committed at the end of the
+    with block, or rolled back if it raises, and then closed.
+    """
+
+    conn = psycopg2.connect(app.config["POSTGRES"], **connection_budget())
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+@app.after_request
+def read_your_writes(response):
+    """Send this admin session's reads to the primary for a while"""
+
+    if hasattr(g, '_database') and app.config.get("POSTGRES_READ") and \
+            request.path.startswith("/admin/") and request.method == "POST":
+        sticky = app.config.get("POSTGRES_READ_STICKY", 10)
+        session["_read_primary_until"] = time.time() + sticky
+
+    return response
+
+def commit_early():
+    """
+    Commit this request's work so far (e.g., to release a lock)
+
+    Afterwards, a degradable view can't be re-run from the snapshot: what
+    it has logged is durable, and would be logged twice.
+    """
+
+    connection().commit()
+    g._committed_early = True
 
 @app.teardown_appcontext
 def close_db_connection(exception):
-    """Commit and close the per-request postgres connection"""
+    """Commit and close the per-request postgres connection(s)"""
+
+    if hasattr(g, '_read_database'):
+        release_connection("POSTGRES_READ", g._read_database)
 
     if hasattr(g, '_database'):
+        committed = False
         try:
+            in_transaction = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+            if getattr(g, "_asynchronous_commit", False) and \
+                    g._database.get_transaction_status() == in_transaction:
+                # the rest of a Twilio request's writes (calls.line,
+                # webhook_responses, human_dials, ...) may be lost if
+                # PostgreSQL crashes in the next few hundred milliseconds,
+                # but aren't worth an fsync on the webhook's critical path
+                with g._database.cursor() as cur:
+                    cur.execute("SET LOCAL synchronous_commit = off")
             g._database.commit()
+            release_webhook_lock(g._database)
+            committed = True
         finally:
-            g._database.close()
+            release_connection("POSTGRES", g._database,
+                               close=not committed)
+
+
+## Cache invalidation
+
+# Triggers in schema.sql NOTIFY this channel, with the table name as the
+# payload, whenever messages or humans change. Each process listens, so
+# that in-process caches across every worker and host are invalidated
+# as soon as a change is committed.
+cache_channel = "notam_cache"
+cache_tables = {"messages": "messages", "humans": "humans",
+                "human_availability": "humans", "humans_roster": "humans",
+                "lines": "lines"}
+
+class CacheListener(object):
+    """
+    LISTENs for cache_channel in a background thread, counting versions
+
+    Enabled by CACHE_NOTIFY. version(name) is None if caching isn't
+    possible (disabled, or not currently listening, in which case a
+    notification could be missed); every version is bumped on
+    (re)connecting.
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.listening = False
+        self.versions = collections.defaultdict(int)
+
+    def version(self, name):
+        if not app.config.get("CACHE_NOTIFY", False):
+            return None
+        if self.pid != os.getpid():
+            with _state_lock:
+                if self.pid != os.getpid():
+                    self._start()
+        if not self.listening:
+            return None
+        return self.versions[name]
+
+    def _start(self):
+        """Start listening in this process (e.g., after uWSGI forks)"""
+        self.pid = os.getpid()
+        self.listening = False
+        thread = threading.Thread(target=self._run, name="cache-listener")
+        thread.daemon = True
+        thread.start()
+
+    def _bump_all(self):
+        for name in set(cache_tables.values()):
+            self.versions[name] += 1
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(app.config["POSTGRES"])
+                conn.set_session(autocommit=True)
+                with conn.cursor() as cur:
+                    cur.execute("LISTEN " + cache_channel)
+
+                # anything may have changed while we weren't listening
+                self._bump_all()
+                self.listening = True
+
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        # check the connection is still alive
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT TRUE")
+                        continue
+
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        name = cache_tables.get(notify.payload)
+                        if name is not None:
+                            self.versions[name] += 1
+
+            except Exception:
+                self.listening = False
+                self._bump_all()
+                logger.warning("Cache listener failed; retrying",
+                               exc_info=True)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+                time.sleep(5)
+
+cache_listener = CacheListener()
+
+class LocalCache(object):
+    """
+    An in-process cache of values (one per key), coherent via CacheListener
+
+    A value is reloaded when the named cache version changes, when the
+    expiry returned by the loader passes, or after CACHE_TTL seconds
+    (default 3600) as a backstop. If the listener isn't listening, the
+    loader is called every time.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = {}
+
+    def get(self, load, key=None):
+        """
+        Get the value for key (e.g., a line); load() should return
+        (value, expires), where expires is a datetime or None
+        """
+
+        version = cache_listener.version(self.name)
+        if version is None:
+            return load()[0]
+
+        now = datetime.datetime.now()
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == version and now < entry[1]:
+            return entry[2]
+
+        # if the version changes while loading, the entry is stale on
+        # arrival and is simply reloaded next time
+        value, expires = load()
+        ttl = now + datetime.timedelta(seconds=app.config.get("CACHE_TTL",
+                                                              3600))
+        if expires is None or expires > ttl:
+            expires = ttl
+        self.entries[key] = (version, expires, value)
+        return value
+
+    def caching(self):
+        """Is the cache in use (so loads should read from the primary)?"""
+        return cache_listener.version(self.name) is not None
+
+
+## Lines
+
+# Each Twilio number ("line") has its own messages and humans. Numbers
+# not in the lines table are answered as default_line, as is web.json
+# without ?line=.
+default_line = 1
+
+def lines_index():
+    """
+    Get ({id: line}, {phone: id}) for every line
+
+    Each line is a {"id": i, "name": n, "phone": p} dict.
+    """
+
+    query = "SELECT id, name, phone FROM lines ORDER BY id"
+
+    def load():
+        read_only = not lines_cache.caching()
+        with cursor(True, read_only=read_only) as cur:
+            cur.execute(query)
+            return index_lines(cur.fetchall()), None
+
+    if degraded():
+        return index_lines(load_snapshot()["lines"])
+
+    schedule = shared_schedule.read()
+    if schedule is not None:
+        return schedule["lines"]
+
+    return lines_cache.get(load)
+
+lines_cache = LocalCache("lines")
+
+def index_lines(lines):
+    by_id = collections.OrderedDict((line["id"], line) for line in lines)
+    by_phone = dict((line["phone"], line["id"]) for line in lines
+                    if line["phone"] is not None)
+    return by_id, by_phone
+
+@app.template_global('all_lines')
+def all_lines():
+    """Get {id: line} for every line, in order; see lines_index"""
+    return lines_index()[0]
+
+@app.template_global('current_line')
+def current_line():
+    """
+    Get the id of the line this request is for
+
+    Admin pages are for the line chosen with select_line. Otherwise
+    ?line= (in web.json, or URLs we give Twilio) says, or else Twilio
+    requests are for the line whose number was called.
+    """
+
+    assert flask.has_request_context()
+
+    if not hasattr(g, "_line"):
+        lines, numbers = lines_index()
+
+        if request.path.startswith("/admin/"):
+            line = session.get("line", default_line)
+            if line not in lines:
+                # e.g., deleted since it was chosen
+                line = default_line
+        elif "line" in request.args:
+            line = intbrq(request.args["line"])
+            if line not in lines:
+                abort(404)
+        elif request.path.startswith("/twilio/"):
+            line = numbers.get(request.form.get("To"), default_line)
+        else:
+            line = default_line
+
+        g._line = line
+
+    return g._line
 
 
 ## Logging and call_log
@@ -100,8 +615,13 @@ def get_sid():
     else:
         return request.form["CallSid"]
 
-def call_log(message):
-    """Log message (via logging) and add it to the call_log table"""
+def call_log(message, seconds_ago=0):
+    """
+    Log message (via logging) and add it to the call_log table
+
+    If seconds_ago is set, the line is timestamped that long before now,
+    for events we only find out about after the fact.
+    """
 
     assert flask.has_request_context()
 
@@ -110,24 +630,338 @@ def call_log(message):
 
     db_msg = message.encode('ascii', 'replace')
 
-    query1 = "SELECT id FROM calls WHERE sid = %s"
-    query2 = "INSERT INTO calls (sid) VALUES (%s) RETURNING id"
-    query3 = "INSERT INTO call_log (call, time, message) " \
-             "VALUES (%s, LOCALTIMESTAMP, %s)"
+    if call_log_journal.enabled():
+        when = datetime.datetime.now() - \
+               datetime.timedelta(seconds=seconds_ago)
+        # journalled at the end of the request, unless degradable
+        # discards them to re-run the view
+        if not hasattr(g, "_journal_lines"):
+            g._journal_lines = []
+        g._journal_lines.append((sid, when, db_msg))
+        return
+
+    if degraded():
+        hold_call_log(sid, db_msg, seconds_ago)
+        return
+
+    query1 = "INSERT INTO call_log (call, time, message) " \
+             "VALUES (%s, LOCALTIMESTAMP - %s * INTERVAL '1 second', %s) " \
+             "RETURNING time"
+    query2 = "INSERT INTO active_calls (call, started, updated, stage) " \
+             "VALUES (%s, %s, %s, %s) " + active_calls_upsert
 
     with cursor() as cur:
-        cur.execute(query1, (sid, ))
+        call_id = get_or_add_call(cur, sid)
+        cur.execute(query1, (call_id, seconds_ago, db_msg))
+        when = cur.fetchone()[0]
+        cur.execute(query2, (call_id, when, when, db_msg))
+
+def get_or_add_call(cur, sid):
+    """Get the id of the call with SID sid, adding it if necessary"""
+
+    query1 = "SELECT id FROM calls WHERE sid = %s"
+    # the call log journal's flusher may add the call concurrently
+    query2 = "INSERT INTO calls (sid) VALUES (%s) " \
+             "ON CONFLICT (sid) DO NOTHING RETURNING id"
+
+    cur.execute(query1, (sid, ))
+    if not cur.rowcount:
+        cur.execute(query2, (sid, ))
         if not cur.rowcount:
-            cur.execute(query2, (sid, ))
-        call_id = cur.fetchone()[0]
-        cur.execute(query3, (call_id, db_msg))
+            cur.execute(query1, (sid, ))
+    return cur.fetchone()[0]
 
-def get_call_sid(call_id):
-    """Get the call SID for a call id"""
+def record_call_line():
+    """Record which line the call in this request is on"""
+
+    if degraded():
+        return
+
+    # the call may not be in calls yet, if call_log() is journalled
+    query = "INSERT INTO calls (sid, line) VALUES (%s, %s) " \
+            "ON CONFLICT (sid) DO UPDATE SET line = EXCLUDED.line"
 
-    query = "SELECT sid FROM calls WHERE id = %s"
     with cursor() as cur:
-        cur.execute(query, (call_id, ))
+        cur.execute(query, (get_sid(), current_line()))
+
+class CallLogJournal(object):
+    """
+    Local write-ahead journal for call log lines
+
+    If CALL_LOG_JOURNAL_DIR is set, call_log() holds lines in the request
+    and they are appended here when it ends (see journal_call_log),
+    rather than waiting for PostgreSQL. Each process has its own journal
+    files in that directory. A background thread fsyncs the journal every
+    CALL_LOG_JOURNAL_SYNC seconds (default 0.05), so that lines are made
+    durable in groups, and every CALL_LOG_JOURNAL_FLUSH seconds (default
+    1) inserts the lines in batches.
+
+    Each line has a unique key, stored in call_log.journal_key, so that
+    re-inserting lines (after a crash between the insert and deleting the
+    journal file) has no effect. Journal files left by dead processes are
+    claimed and flushed by the others.
+
+    get_call_log_for_sid reads through every process' journal files, for
+    lines not yet inserted.
+
+    Only call_log is journalled. The rest of a Twilio request's writes
+    (record_call_line, webhook_responses, human_dials and so on) are still
+    committed when it ends, but with synchronous_commit off, so that the
+    request doesn't wait for PostgreSQL to fsync them.
+    """
+
+    _time_format = "%Y-%m-%d %H:%M:%S.%f"
+
+    def __init__(self):
+        self.pid = None
+
+    def enabled(self):
+        return bool(app.config.get("CALL_LOG_JOURNAL_DIR"))
+
+    def _start(self):
+        """Set up for this process (e.g., after uWSGI forks a worker)"""
+
+        pid = os.getpid()
+        self.directory = app.config["CALL_LOG_JOURNAL_DIR"]
+        self.sync_interval = app.config.get("CALL_LOG_JOURNAL_SYNC", 0.05)
+        self.flush_interval = app.config.get("CALL_LOG_JOURNAL_FLUSH", 1.0)
+
+        self.lock = threading.Lock()
+        self.prefix = "{0}-{1}".format(pid, int(time.time() * 1000))
+        self.counter = itertools.count()
+        self.unflushed = collections.OrderedDict()
+        self.segments = itertools.count()
+        self.unflushed_paths = []
+        self.dirty = False
+        self.conn = None
+        self._open_segment()
+        # last: append checks it without the lock
+        self.pid = pid
+
+        thread = threading.Thread(target=self._run, name="call-log-journal")
+        thread.daemon = True
+        thread.start()
+
+    def _segment_path(self, segment):
+        name = "journal-{0}-{1}.jsonl".format(self.prefix, segment)
+        return os.path.join(self.directory, name)
+
+    def _open_segment(self):
+        path = self._segment_path(next(self.segments))
+        self.file = open(path, "a")
+        self.unflushed_paths.append(path)
+
+    def append(self, sid, when, message):
+        """Add a line to the journal (not waiting for it to be fsynced)"""
+
+        if self.pid != os.getpid():
+            with _state_lock:
+                if self.pid != os.getpid():
+                    self._start()
+
+        with self.lock:
+            key = "{0}-{1}".format(self.prefix, next(self.counter))
+            line = json.dumps([key, sid, when.strftime(self._time_format),
+                               message])
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.dirty = True
+            self.unflushed[key] = (sid, when, message)
+
+    def pending(self, sid):
+        """
+        Get every process' un-inserted (key, time, message)s for sid
+
+        A call's lines are often journalled by several workers, so this
+        reads all the journal files, not just ours. Files are only
+        deleted once their lines are inserted, so call this before
+        SELECTing from call_log and every line is in one or the other.
+        """
+
+        directory = app.config["CALL_LOG_JOURNAL_DIR"]
+
+        for attempt in range(3):
+            lines = {}
+            renamed = False
+            for path in glob.glob(os.path.join(directory, "*-*.jsonl")):
+                try:
+                    journal = self._read(path)
+                except (IOError, OSError) as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    # flushed (fine) or claimed as an orphan (not read)
+                    renamed = True
+                    continue
+                for key, line_sid, when, message in journal:
+                    if line_sid == sid:
+                        lines[key] = (key, when, message)
+            if not renamed:
+                break
+
+        return sorted(lines.values(), key=lambda line: line[1])
+
+    def _run(self):
+        last_flush = time.time()
+
+        while True:
+            time.sleep(self.sync_interval)
+
+            with self.lock:
+                dirty = self.dirty
+                self.dirty = False
+                fd = self.file.fileno()
+            if dirty:
+                # only this thread closes files, so fd stays valid
+                os.fsync(fd)
+
+            if time.time() - last_flush >= self.flush_interval:
+                last_flush = time.time()
+                try:
+                    self.flush()
+                except Exception:
+                    logger.warning("Failed to flush call log journal",
+                                   exc_info=True)
+                    if self.conn is not None:
+                        self.conn.close()
+                        self.conn = None
+
+    def _claim_orphans(self):
+        """
+        Claim journal files left behind by processes that have died
+
+        Claimed files are renamed to orphan-<our prefix>-..., so files
+        that we claimed but failed to flush are picked up again next time,
+        and by someone else if we die too.
+        """
+
+        claimed = []
+        for path in glob.glob(os.path.join(self.directory, "*-*.jsonl")):
+            name = os.path.basename(path)
+            # journal-<pid>-... or orphan-<pid>-...
+            pid = int(name.split("-")[1])
+            if name.startswith("orphan-{0}-".format(self.prefix)):
+                claimed.append(path)
+                continue
+            if pid == self.pid or process_alive(pid):
+                continue
+
+            claim = os.path.join(self.directory,
+                                 "orphan-{0}-{1}".format(self.prefix, name))
+            try:
+                os.rename(path, claim)
+            except OSError:
+                # someone else got there first
+                continue
+            claimed.append(claim)
+
+        return sorted(claimed)
+
+    def _read(self, path):
+        lines = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    key, sid, when, message = json.loads(line)
+                except ValueError:
+                    # torn final line from a crash
+                    continue
+                when = datetime.datetime.strptime(when, self._time_format)
+                lines.append((key, sid, when, message))
+        return lines
+
+    def flush(self):
+        """Insert pending (and orphaned) lines, then delete their files"""
+
+        with self.lock:
+            batch = [(key, sid, when, message) for key, (sid, when, message)
+                     in self.unflushed.items()]
+            if batch:
+                old_file = self.file
+                self._open_segment()
+            else:
+                old_file = None
+
+        if old_file is not None:
+            os.fsync(old_file.fileno())
+            old_file.close()
+
+        orphans = self._claim_orphans()
+        for path in orphans:
+            batch += self._read(path)
+
+        if batch:
+            self._insert(batch)
+
+        with self.lock:
+            for key, sid, when, message in batch:
+                self.unflushed.pop(key, None)
+            # every path but the one being appended to is now flushed
+            done = self.unflushed_paths[:-1]
+            del self.unflushed_paths[:-1]
+
+        for path in done + orphans:
+            os.unlink(path)
+
+    def _insert(self, batch):
+        query1 = "INSERT INTO calls (sid) SELECT UNNEST(%s) " \
+                 "ON CONFLICT (sid) DO NOTHING"
+        query2 = "INSERT INTO call_log (call, time, message, journal_key) " \
+                 "SELECT c.id, v.time, v.message, v.key " \
+                 "FROM (VALUES %s) AS v (key, sid, time, message) " \
+                 "JOIN calls AS c ON c.sid = v.sid " \
+                 "ON CONFLICT (journal_key) DO NOTHING"
+        query3 = "INSERT INTO active_calls (call, started, updated, stage) " \
+                 "SELECT c.id, v.started, v.updated, v.stage " \
+                 "FROM (VALUES %s) AS v (sid, started, updated, stage) " \
+                 "JOIN calls AS c ON c.sid = v.sid " + active_calls_upsert
+        template = "(%s, %s, %s::TIMESTAMP, %s)"
+
+        if self.conn is None:
+            self.conn = psycopg2.connect(app.config["POSTGRES"])
+
+        # the call board gets each call's first and last line
+        board = {}
+        for key, sid, when, message in batch:
+            started, updated, stage = board.get(sid, (when, when, message))
+            if when >= updated:
+                updated, stage = when, message
+            board[sid] = (min(started, when), updated, stage)
+        board = [(sid, ) + board[sid] for sid in sorted(board)]
+
+        with self.conn.cursor() as cur:
+            cur.execute(query1, ([sid for sid, s, u, m in board], ))
+            execute_values(cur, query2, batch, template=template,
+                           page_size=1000)
+            execute_values(cur, query3, board,
+                           template="(%s, %s::TIMESTAMP, %s::TIMESTAMP, %s)",
+                           page_size=1000)
+        self.conn.commit()
+
+call_log_journal = CallLogJournal()
+
+@app.teardown_appcontext
+def journal_call_log(exception):
+    """Append this request's call log lines to the journal"""
+    if hasattr(g, "_journal_lines"):
+        for sid, when, message in g._journal_lines:
+            call_log_journal.append(sid, when, message)
+        del g._journal_lines
+
+def process_alive(pid):
+    """Is there a process with this pid?"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    else:
+        return True
+
+def get_call_sid(call_id):
+    """Get the call SID for a call id (of a call to this line)"""
+
+    query = "SELECT sid FROM calls WHERE id = %s AND line = %s"
+    with cursor(read_only=True) as cur:
+        cur.execute(query, (call_id, current_line()))
         if cur.rowcount:
             return cur.fetchone()[0]
         else:
@@ -145,7 +979,7 @@ def get_call_log_for_id(call_id, return_dicts=False):
             "WHERE call = %s " \
             "ORDER BY time ASC, id ASC"
 
-    with cursor(return_dicts) as cur:
+    with cursor(return_dicts, read_only=True) as cur:
         cur.execute(query, (call_id, ))
         return cur.fetchall()
 
@@ -162,26 +996,54 @@ def get_call_log_for_sid(sid=None, return_dicts=False):
     if sid is None:
         sid = get_sid()
 
-    query = "SELECT time, message FROM call_log " \
+    query = "SELECT time, message, journal_key FROM call_log " \
             "WHERE call = (SELECT id FROM calls WHERE sid = %s) " \
             "ORDER BY time ASC, id ASC"
 
-    with cursor(return_dicts) as cur:
-        cur.execute(query, (sid, ))
-        return cur.fetchall()
+    if call_log_journal.enabled():
+        # first: lines leave the journal only once they're in call_log
+        pending = call_log_journal.pending(sid)
+        # and this request's, which aren't journalled yet
+        pending += [(None, when, message) for (line_sid, when, message)
+                    in getattr(g, "_journal_lines", []) if line_sid == sid]
+    else:
+        pending = []
+
+    if degraded():
+        # only the lines held since the database went away
+        lines = [(time, message, None) for (held_sid, time, message)
+                 in read_held_call_log() if held_sid == sid]
+    else:
+        with cursor() as cur:
+            cur.execute(query, (sid, ))
+            lines = cur.fetchall()
+
+    if pending:
+        # read through lines not yet flushed (or flushed since reading)
+        keys = set(key for time, message, key in lines)
+        lines += [(time, message, key) for (key, time, message)
+                  in pending if key not in keys]
+        lines.sort(key=lambda line: line[0])
+
+    if return_dicts:
+        return [{"time": time, "message": message}
+                for time, message, key in lines]
+    else:
+        return [(time, message) for time, message, key in lines]
 
 def calls_count():
-    """Count the rows in the calls table"""
+    """Count the calls to this line"""
 
-    query = "SELECT COUNT(*) AS count FROM calls"
+    query = "SELECT COUNT(*) AS count FROM calls WHERE line = %s"
 
-    with cursor() as cur:
-        cur.execute(query)
+    with cursor(read_only=True) as cur:
+        cur.execute(query, (current_line(), ))
         return cur.fetchone()[0]
 
 def call_log_first_lines(offset=0, limit=100):
     """
-    Get a list of calls and for each, their first lines in the call log
+    Get a list of calls to this line and for each, their first lines in
+    the call log
 
     A list of {"call": call_id, "first_time": time, "first_message": message}
     dicts is returned.
@@ -189,184 +1051,1105 @@ def call_log_first_lines(offset=0, limit=100):
     # assumes entries in the calls table have at least one line in the log
 
     query = "SELECT " \
-            "DISTINCT ON (call) " \
-            "   call, time AS first_time, " \
-            "   message AS first_message " \
-            "FROM call_log " \
-            "ORDER BY call ASC, time ASC, id ASC " \
+            "DISTINCT ON (l.call) " \
+            "   l.call, l.time AS first_time, " \
+            "   l.message AS first_message " \
+            "FROM calls AS c JOIN call_log AS l ON l.call = c.id " \
+            "WHERE c.line = %s " \
+            "ORDER BY l.call ASC, l.time ASC, l.id ASC " \
             "LIMIT %s OFFSET %s"
 
-    with cursor(True) as cur:
-        cur.execute(query, (limit, offset))
+    with cursor(True, read_only=True) as cur:
+        cur.execute(query, (current_line(), limit, offset))
         return cur.fetchall()
 
-def email(subject, message):
-    """Send an email"""
-
-    logger.debug("email: %s %r", subject, message)
-
-    email = "From: {0}\r\nTo: {1}\r\nSubject: CUSF Notam Twilio {2}\r\n\r\n" \
-        .format(app.config['EMAIL_FROM'], ",".join(app.config['EMAIL_TO']),
-                subject) \
-        + message
+def record_dials(human_ids):
+    """Record that the humans human_ids are being dialled for this call"""
 
-    server = smtplib.SMTP(app.config['EMAIL_SERVER'])
-    server.sendmail(app.config['EMAIL_FROM'], app.config['EMAIL_TO'], email)
-    server.quit()
+    if degraded():
+        return
 
+    query = "INSERT INTO human_dials (call, human, dialled) " \
+            "SELECT %s, UNNEST(%s), LOCALTIMESTAMP"
 
-## Other database queries
+    with cursor() as cur:
+        call_id = get_or_add_call(cur, get_sid())
+        cur.execute(query, (call_id, list(human_ids)))
 
-def all_humans():
+def record_dial_answered(human_id=None, seconds_ago=0):
     """
-    Get all humans, sorted by priority then name
+    Record that a human being dialled for this call answered
 
-    A list of {"id": id, "name": name, "phone": phone, "priority": priority}
-    dicts is returned.
+    If human_id is None, all of the call's outstanding dials are marked
+    (use only if there is just one).
     """
 
-    query = "SELECT id, name, phone, priority FROM humans " \
-            "ORDER BY priority ASC, name ASC " \
+    if degraded():
+        return
 
-    # put disabled humans at the end. priority is a smallint, so...
-    key = lambda h: 100000 if h["priority"] == 0 else h["priority"]
+    query = "UPDATE human_dials " \
+            "SET answered = LOCALTIMESTAMP - %s * INTERVAL '1 second' " \
+            "WHERE call = (SELECT id FROM calls WHERE sid = %s) " \
+            "AND status IS NULL AND answered IS NULL"
+    params = [seconds_ago, get_sid()]
 
-    with cursor(True) as cur:
-        cur.execute(query)
-        humans = cur.fetchall()
-        humans.sort(key=key)
-        return humans
+    if human_id is not None:
+        query += " AND human = %s"
+        params.append(human_id)
 
-def update_human_priority(human_id, new_priority):
-    """Update the priority column of a single human"""
-    query = "UPDATE humans SET priority = %s WHERE id = %s"
     with cursor() as cur:
-        cur.execute(query, (new_priority, human_id))
+        cur.execute(query, params)
+
+def record_dials_ended(dial_status):
+    """
+    Record the outcome of this call's outstanding dials
+
+    dial_status is the DialCallStatus. Humans in a ring group who didn't
+    answer when someone else did are recorded as 'canceled'.
+    """
+
+    if degraded():
+        return
+
+    query = "UPDATE human_dials " \
+            "SET status = CASE " \
+            "    WHEN answered IS NOT NULL THEN 'completed' " \
+            "    WHEN %(s)s = 'completed' THEN 'canceled' " \
+            "    ELSE %(s)s END " \
+            "WHERE call = (SELECT id FROM calls WHERE sid = %(sid)s) " \
+            "AND status IS NULL"
 
-def add_human(name, phone, priority):
-    """Add a human"""
-    query = "INSERT INTO humans (name, phone, priority) VALUES (%s, %s, %s)"
     with cursor() as cur:
-        cur.execute(query, (name, phone, priority))
+        cur.execute(query, {"s": dial_status, "sid": get_sid()})
 
-def shuffled_humans(seed):
+_dial_stats_cache = (None, {})
+
+def human_dial_stats():
     """
-    Get all humans, sorted by priority.
+    Get per-human dialling statistics from the last 90 days of dials
 
-    Humans with equal priorities are shuffled randomly, with an RNG
-    seeded with seed.
+    Only dials before today are included, so that the stats (and hence
+    the shuffled_humans ordering for a given seed) don't change during
+    a call; they are cached until midnight.
 
-    Returns a list of (priority, name, phone) tuples.
+    Returns a {human_id: {"dials": n, "answered": n, "pickup_p90": s}}
+    dict, where pickup_p90 is the 90th percentile of seconds from dialling
+    to answering (None if never answered).
     """
 
-    query = "SELECT priority, name, phone FROM humans " \
-            "WHERE priority > 0 ORDER BY id ASC"
+    global _dial_stats_cache
 
-    with cursor() as cur:
-        cur.execute(query)
-        humans = cur.fetchall()
+    today = datetime.date.today()
+    if _dial_stats_cache[0] == today:
+        return _dial_stats_cache[1]
+    elif degraded():
+        return {}
 
-    rng = random.Random(seed)
-    humans = [(priority + rng.uniform(0.1, 0.2), name, phone)
-              for (priority, name, phone) in humans]
-    humans.sort()
+    query = "SELECT human, COUNT(*) AS dials, " \
+            "    COUNT(answered) AS answered, " \
+            "    PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY " \
+            "        EXTRACT(EPOCH FROM answered - dialled)) AS pickup_p90 " \
+            "FROM human_dials " \
+            "WHERE dialled >= %s::DATE - 90 AND dialled < %s::DATE " \
+            "AND status IS NOT NULL AND status != 'canceled' " \
+            "GROUP BY human"
 
-    return humans
+    with cursor(True) as cur:
+        cur.execute(query, (today, today))
+        stats = dict((row.pop("human"), row) for row in cur.fetchall())
 
-_message_query = "SELECT m.id, m.active_when, m.short_name, " \
-                 "       m.web_short_text, m.web_long_text, " \
-                 "       m.call_text, m.forward_to, " \
-                 "       h.name AS forward_name, h.phone AS forward_phone, " \
-                 "       LOCALTIMESTAMP <@ active_when AS active " \
-                 "FROM messages AS m " \
-                 "LEFT OUTER JOIN humans AS h ON m.forward_to = h.id "
+    _dial_stats_cache = (today, stats)
+    return stats
 
-def active_message():
+default_dial_timeout = 30   # Twilio's default
+min_dial_timeout = 10
+
+def dial_timeout(stats):
     """
-    Get the active message, if it exists.
+    Work out how long to ring a human for, from their human_dial_stats
 
-    Returns a {"id": i, "active_when": a, "short_name": s,
-    "web_short_text": wst, "web_long_text": wlt, "call_text": ct,
-    "forward_to": human_id, "forward_name": human_name,
-    "forward_phone": human_phone, "active": bool} dict,
-    or None if there isn't an active message.
+    Humans who reliably answer are rung for a little longer than they
+    usually take; humans who never answer are given up on quickly.
     """
 
-    query = _message_query + \
-            "WHERE LOCALTIMESTAMP <@ active_when"
+    if stats is None:
+        return default_dial_timeout
+    elif stats["answered"] >= 3:
+        timeout = int(math.ceil(stats["pickup_p90"])) + 5
+        return max(min_dial_timeout, min(default_dial_timeout, timeout))
+    elif stats["dials"] >= 5 and stats["answered"] == 0:
+        return min_dial_timeout
+    else:
+        return default_dial_timeout
 
-    with cursor(True) as cur:
-        cur.execute(query)
-        if cur.rowcount == 1:
-            return cur.fetchone()
-        elif cur.rowcount == 0:
-            return None
-        else:
-            raise AssertionError("cur.rowcount should be 0 or 1")
+def answer_rate_hint(stats):
+    """Estimated probability that a human answers (Laplace smoothed)"""
+    if stats is None:
+        return 0.5
+    else:
+        return (stats["answered"] + 1.0) / (stats["dials"] + 2.0)
 
-def messages_count():
-    """Count the rows in the messages table"""
+def adaptive_dial():
+    """Use human_dial_stats for dial timeouts and ordering?"""
+    return app.config.get("TWILIO_ADAPTIVE_DIAL", False)
 
-    query = "SELECT COUNT(*) AS count FROM messages"
+# With TWILIO_FORWARD_LIMIT set, at most that many callers per line are put
+# through to the line's humans at once (from pressing 2 until their dial
+# chain ends); the rest wait, in order, in a Twilio queue per line. Rows
+# more than two hours old are ignored, in case a status callback never
+# arrived.
 
-    with cursor() as cur:
-        cur.execute(query)
-        return cur.fetchone()[0]
+forward_queue = "humans-{0}"
+_forward_lock = 0x4e4f544d      # pg_advisory_xact_lock key, with the line
 
-def all_messages(offset, limit=5):
+def forward_limit():
+    return app.config.get("TWILIO_FORWARD_LIMIT")
+
+def admit_human_forward(queued=False):
     """
-    Get all messages
+    Try to admit the call in this request to the humans
 
-    Returns a list of messages in the same form as active_message()
+    If queued is False, the caller has just pressed 2, and is admitted if
+    there is room and nobody is waiting; otherwise they are recorded as
+    waiting. If True, they are in the queue, and are admitted if there is
+    room and they are at its head. Returns True if admitted.
     """
 
-    query = _message_query + \
-            "ORDER BY active_when " \
-            "OFFSET %s LIMIT %s"
+    if not forward_limit() or degraded():
+        return True
+
+    query1 = "SELECT pg_advisory_xact_lock(%s, %s)"
+    query2 = "SELECT " \
+             "    COUNT(*) FILTER (WHERE f.started IS NOT NULL), " \
+             "    (ARRAY_AGG(f.call ORDER BY f.queued, f.call) " \
+             "        FILTER (WHERE f.started IS NULL))[1] " \
+             "FROM human_forwards AS f JOIN calls AS c ON c.id = f.call " \
+             "WHERE f.ended IS NULL AND c.line = %s AND " \
+             "    f.queued > LOCALTIMESTAMP - INTERVAL '2 hours'"
+    query3 = "INSERT INTO human_forwards (call, queued) " \
+             "VALUES (%s, LOCALTIMESTAMP) " \
+             "ON CONFLICT (call) DO UPDATE " \
+             "SET queued = EXCLUDED.queued, started = NULL, ended = NULL"
+    query4 = "UPDATE human_forwards SET started = LOCALTIMESTAMP " \
+             "WHERE call = %s"
 
+    with cursor() as cur:
+        call_id = get_or_add_call(cur, get_sid())
+        cur.execute(query1, (_forward_lock, current_line()))
+        cur.execute(query2, (current_line(), ))
+        in_progress, first_waiting = cur.fetchone()
 
-    with cursor(True) as cur:
-        cur.execute(query, (offset, limit))
-        return cur.fetchall()
+        if not queued:
+            cur.execute(query3, (call_id, ))
+            if first_waiting is None:
+                first_waiting = call_id
 
-def get_message(message_id):
-    """
-    Gets a specific message by its id
+        admitted = in_progress < forward_limit() and first_waiting == call_id
+        if admitted:
+            cur.execute(query4, (call_id, ))
 
-    Returns all columns, as a dict.
-    """
+    # release the lock
+    commit_early()
+    return admitted
 
-    query = "SELECT * FROM messages WHERE id = %s"
+def human_forward_started():
+    """Was the call in this request admitted (and not since ended)?"""
 
-    with cursor(True) as cur:
-        cur.execute(query, (message_id, ))
-        return cur.fetchone()
+    if not forward_limit() or degraded():
+        return True
 
-_message_columns = ("short_name", "web_short_text", "web_long_text",
-                    "call_text", "forward_to", "active_when")
+    query = "SELECT started IS NOT NULL FROM human_forwards " \
+            "WHERE call = (SELECT id FROM calls WHERE sid = %s) " \
+            "AND ended IS NULL"
 
-def upsert_message(message):
-    """
-    Insert or update a message (depending on whether message["id"] is present)
+    with cursor() as cur:
+        cur.execute(query, (get_sid(), ))
+        return cur.rowcount == 1 and cur.fetchone()[0]
 
-    message should be a dict in the same form as active_message() returns,
-    minus the 'active', 'forward_name', 'forward_phone' keys,
-    and with the 'id' key optional.
+def end_human_forward():
+    """Give up the call in this request's place in the queue, or slot"""
 
-    Automatically moves intersecting (active_when) messages out of the way,
-    returning a list of affected message dicts in form:
-    {"id": id, "short_name": short_name, "action": action}
-    where action is one of "deleted", "end_earlier", "start_later".
-    """
+    if not forward_limit() or degraded():
+        return
 
-    query1 = "WITH " \
-             "deleted AS ( " \
-             "    DELETE FROM messages " \
-             "    WHERE {0} active_when <@ %(n)s " \
-             "    RETURNING 'delete'::TEXT AS action, " \
-             "        short_name, active_when "\
-             "), " \
-             "end_earlier AS ( " \
+    query = "UPDATE human_forwards SET ended = LOCALTIMESTAMP " \
+            "WHERE call = (SELECT id FROM calls WHERE sid = %s) " \
+            "AND ended IS NULL"
+
+    with cursor() as cur:
+        cur.execute(query, (get_sid(), ))
+
+def email(subject, message):
+    """Send an email"""
+
+    logger.debug("email: %s %r", subject, message)
+
+    email = "From: {0}\r\nTo: {1}\r\nSubject: CUSF Notam Twilio {2}\r\n\r\n" \
+        .format(app.config['EMAIL_FROM'], ",".join(app.config['EMAIL_TO']),
+                subject) \
+        + message
+
+    server = smtplib.SMTP(app.config['EMAIL_SERVER'])
+    server.sendmail(app.config['EMAIL_FROM'], app.config['EMAIL_TO'], email)
+    server.quit()
+
+# Call reports (the call log, formatted for email) are stored in
+# call_reports when a call ends. If EMAIL_DIGEST_MINUTES is set, they are
+# sent together, once the oldest unsent report is that many minutes old or
+# EMAIL_DIGEST_CALLS (default 20) are waiting; otherwise, and for calls
+# with urgent_call_log_prefixes lines, each is emailed immediately.
+#
+# Digests are sent by a background thread in each process, on its own
+# connection, so that a slow mail server never holds up Twilio's webhooks.
+
+urgent_call_log_prefixes = ("Humans exhausted", )
+
+def email_digest_minutes():
+    return app.config.get("EMAIL_DIGEST_MINUTES")
+
+def format_call_report(lines):
+    """Format (time, message) call log lines for email"""
+    return "\n".join("{0} {1}".format(time.strftime("%H:%M:%S"), message)
+                     for time, message in lines)
+
+def add_call_report(caller, summary, urgent, claimed):
+    """
+    Store the report for the call in this request
+
+    If claimed is set, the report is marked emailed as it is inserted, so
+    that no digest can claim it too; the caller is about to email it.
+
+    Returns the call id, or None if the call already has a report (Twilio
+    retried the status callback).
+    """
+
+    query = "INSERT INTO call_reports " \
+            "(call, ended, caller, summary, urgent, emailed) " \
+            "VALUES (%s, LOCALTIMESTAMP, %s, %s, %s, " \
+            "        CASE WHEN %s THEN LOCALTIMESTAMP END) " \
+            "ON CONFLICT (call) DO NOTHING"
+
+    with cursor() as cur:
+        call_id = get_or_add_call(cur, get_sid())
+        cur.execute(query, (call_id, caller, summary, urgent, claimed))
+        return call_id if cur.rowcount else None
+
+def unclaim_call_report(call_id):
+    """Leave a report that couldn't be emailed for the next digest"""
+    query = "UPDATE call_reports SET emailed = NULL WHERE call = %s"
+    with cursor() as cur:
+        cur.execute(query, (call_id, ))
+
+def reclaim_call_report():
+    """
+    Check for an existing report for the call in this request (Twilio
+    retried the status callback, e.g. after emailing it failed)
+
+    Returns None if there is no report. Otherwise, if the report is unsent
+    and should be emailed at once, it is claimed and (call id, caller,
+    summary) is returned; if not, False.
+    """
+
+    query1 = "SELECT r.call FROM call_reports AS r " \
+             "JOIN calls AS c ON c.id = r.call WHERE c.sid = %s"
+    query2 = "UPDATE call_reports SET emailed = LOCALTIMESTAMP " \
+             "WHERE call = %s AND emailed IS NULL AND (urgent OR %s) " \
+             "RETURNING call, caller, summary"
+
+    with cursor() as cur:
+        cur.execute(query1, (get_sid(), ))
+        if not cur.rowcount:
+            return None
+        call_id = cur.fetchone()[0]
+
+        cur.execute(query2, (call_id, not email_digest_minutes()))
+        return cur.fetchone() if cur.rowcount else False
+
+def email_call_report(call_id, caller, summary):
+    """Email a claimed report, unclaiming it (and re-raising) on failure"""
+
+    # the report is safe even if emailing fails
+    commit_early()
+
+    try:
+        email("Call from {0}".format(caller), summary)
+    except Exception:
+        unclaim_call_report(call_id)
+        commit_early()
+        raise
+
+def claim_call_reports(conn):
+    """
+    If a digest is due, mark the unsent reports emailed and return them
+
+    The UPDATE locks the rows, so concurrent callers claim each report at
+    most once. The caller must commit after sending, or roll back.
+    """
+
+    query1 = "SELECT COUNT(*) AS count, " \
+             "       MIN(ended) < LOCALTIMESTAMP - %s * INTERVAL '1 minute' " \
+             "           AS overdue " \
+             "FROM call_reports WHERE emailed IS NULL"
+    query2 = "UPDATE call_reports SET emailed = LOCALTIMESTAMP " \
+             "WHERE emailed IS NULL " \
+             "RETURNING call, ended, caller, summary"
+
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(query1, (email_digest_minutes(), ))
+        unsent = cur.fetchone()
+        if not unsent["overdue"] and \
+                unsent["count"] < app.config.get("EMAIL_DIGEST_CALLS", 20):
+            return []
+
+        cur.execute(query2)
+        return sorted(cur.fetchall(), key=lambda r: (r["ended"], r["call"]))
+
+def send_call_report_digest(conn):
+    """Email unsent call reports as one message, if a digest is due"""
+
+    try:
+        reports = claim_call_reports(conn)
+        if not reports:
+            conn.rollback()
+            return
+
+        sections = ["Call from {0} (ended {1})\n{2}"
+                        .format(r["caller"], r["ended"].strftime("%H:%M:%S"),
+                                r["summary"])
+                    for r in reports]
+        subject = "digest: {0} call{1}" \
+                    .format(len(reports), "" if len(reports) == 1 else "s")
+
+        email(subject, "\n\n\n".join(sections))
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+
+class CallReportDigests(object):
+    """Checks for a due digest once a minute, in a background thread"""
+
+    def __init__(self):
+        self.pid = None
+
+    def start(self):
+        """Start the thread in this process, if it isn't running"""
+        if self.pid != os.getpid():
+            with _state_lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    thread = threading.Thread(target=self._run,
+                                              name="call-report-digests")
+                    thread.daemon = True
+                    thread.start()
+
+    def _run(self):
+        conn = None
+        while True:
+            time.sleep(60)
+            try:
+                if conn is None:
+                    conn = psycopg2.connect(app.config["POSTGRES"])
+                send_call_report_digest(conn)
+            except Exception:
+                # (anything: this thread must keep running)
+                logger.warning("Failed to send call report digest",
+                               exc_info=True)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+                    conn = None
+
+call_report_digests = CallReportDigests()
+
+@app.after_request
+def maintain_call_report_digest(response):
+    """Make sure this process is sending digests, if they're enabled"""
+    if email_digest_minutes():
+        call_report_digests.start()
+    return response
+
+# Incoming texts are buffered in each worker and inserted into sms_log
+# in bulk, once SMS_LOG_BATCH (default 50) are waiting or the oldest is
+# a minute old. The buffer is bounded, so if PostgreSQL is unavailable
+# for long the oldest lines are dropped (they are in syslog too).
+
+_sms_log = []
+
+def log_sms(sender, body, reply):
+    """Buffer a line for sms_log; reply is None if we didn't reply"""
+    with _state_lock:
+        _sms_log.append((datetime.datetime.now(), sender, body, reply))
+        del _sms_log[:-1000]
+
+def flush_sms_log(force=False):
+    """Insert buffered sms_log lines, if there are enough or they're old"""
+
+    batch = app.config.get("SMS_LOG_BATCH", 50)
+    old = datetime.datetime.now() - datetime.timedelta(minutes=1)
+
+    # claim them, so that concurrent requests don't insert them too
+    with _state_lock:
+        if not _sms_log:
+            return
+        if not force and len(_sms_log) < batch and _sms_log[0][0] > old:
+            return
+        lines = _sms_log[:]
+        del _sms_log[:]
+
+    query = "INSERT INTO sms_log (received, sender, body, reply) VALUES %s"
+
+    try:
+        # not the request's connection: a failure mustn't roll back the
+        # view's writes (and make Twilio retry, re-sending the reply)
+        with separate_connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, query, lines)
+    except:
+        with _state_lock:
+            _sms_log[:0] = lines
+            del _sms_log[:-1000]
+        raise
+
+@app.after_request
+def maintain_sms_log(response):
+    """After a healthy Twilio or heartbeat request, flush the sms_log"""
+
+    if degraded() or response.status_code != 200:
+        return response
+    if not (request.endpoint or "").startswith(("twilio_", "heartbeat")):
+        return response
+
+    try:
+        flush_sms_log()
+    except psycopg2.Error:
+        logger.warning("Failed to insert sms_log lines", exc_info=True)
+
+    return response
+
+
+## Call board
+
+# Each call's latest call log line is kept in active_calls (by call_log,
+# or the journal's flusher), and a trigger NOTIFYs this channel with the
+# call's id, so that the admin call board is pushed changes rather than
+# re-reading the call log.
+call_board_channel = "notam_calls"
+# calls not heard from for this long are assumed to have ended...
+call_board_max_age = datetime.timedelta(hours=2)
+# ...and are deleted after this long, as are ended calls
+call_board_prune_age = datetime.timedelta(days=1)
+
+# lines may arrive out of order (seconds_ago, journals); ended calls are
+# left alone
+active_calls_upsert = \
+    "ON CONFLICT (call) DO UPDATE SET " \
+    "started = LEAST(active_calls.started, EXCLUDED.started), " \
+    "stage = CASE WHEN EXCLUDED.updated >= active_calls.updated " \
+    "        THEN EXCLUDED.stage ELSE active_calls.stage END, " \
+    "updated = GREATEST(active_calls.updated, EXCLUDED.updated) " \
+    "WHERE NOT active_calls.ended"
+
+def end_active_call(message):
+    """Take this call off the call board, and prune long-gone calls"""
+
+    if degraded():
+        return
+
+    query1 = "INSERT INTO active_calls (call, started, updated, stage, ended) " \
+             "VALUES (%s, LOCALTIMESTAMP, LOCALTIMESTAMP, %s, TRUE) " \
+             "ON CONFLICT (call) DO UPDATE " \
+             "SET updated = LOCALTIMESTAMP, stage = EXCLUDED.stage, " \
+             "ended = TRUE"
+    query2 = "DELETE FROM active_calls WHERE updated < LOCALTIMESTAMP - %s"
+
+    with cursor() as cur:
+        call_id = get_or_add_call(cur, get_sid())
+        cur.execute(query1, (call_id, message.encode('ascii', 'replace')))
+        cur.execute(query2, (call_board_prune_age, ))
+
+def select_active_calls(cur, line, call_ids=None):
+    """
+    Get calls to line on the call board, oldest first
+
+    cur should be a RealDictCursor. ringing lists the humans being dialled
+    (or talking). If call_ids is given, just those calls are fetched,
+    ended or not, so that the board can remove ended ones.
+    """
+
+    query = "SELECT a.call, a.stage, a.ended, " \
+            "CAST(EXTRACT(EPOCH FROM LOCALTIMESTAMP - a.started) " \
+            "     AS INTEGER) AS elapsed, " \
+            "ARRAY(SELECT h.name || CASE WHEN d.answered IS NULL " \
+            "                      THEN '' ELSE ' (answered)' END " \
+            "      FROM human_dials AS d JOIN humans AS h ON h.id = d.human " \
+            "      WHERE d.call = a.call AND d.status IS NULL " \
+            "      ORDER BY d.id) AS ringing " \
+            "FROM active_calls AS a JOIN calls AS c ON c.id = a.call " \
+            "WHERE c.line = %s "
+
+    if call_ids is None:
+        query += "AND NOT a.ended AND a.updated > LOCALTIMESTAMP - %s "
+        params = (line, call_board_max_age)
+    else:
+        query += "AND a.call = ANY(%s) "
+        params = (line, sorted(call_ids))
+
+    cur.execute(query + "ORDER BY a.started", params)
+    return cur.fetchall()
+
+def call_board_event(name, data):
+    data = json.dumps(data)
+    return "event: {0}\ndata: {1}\n\n".format(name, data).encode("utf-8")
+
+def call_board_events(dsn, line, duration, keepalive=15):
+    """
+    Yield server-sent events for line's call board, for duration seconds
+
+    First all calls in progress ("calls"), then each call as it changes
+    ("call"). Uses its own connection, since it LISTENs, and outlives the
+    request's.
+    """
+
+    conn = psycopg2.connect(dsn)
+    try:
+        conn.set_session(autocommit=True)
+        with conn.cursor() as cur:
+            cur.execute("LISTEN " + call_board_channel)
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            calls = select_active_calls(cur, line)
+        yield call_board_event("calls", calls)
+
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            timeout = min(keepalive, max(deadline - time.time(), 0))
+            if select.select([conn], [], [], timeout) == ([], [], []):
+                yield b": keepalive\n\n"
+                continue
+
+            conn.poll()
+            call_ids = set(int(n.payload) for n in conn.notifies)
+            del conn.notifies[:]
+            if call_ids:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    for call in select_active_calls(cur, line, call_ids):
+                        yield call_board_event("call", call)
+    finally:
+        conn.close()
+
+
+## Other database queries
+
+def all_humans():
+    """
+    Get all of this line's humans, sorted by priority then name
+
+    A list of {"id": id, "name": name, "phone": phone, "priority": priority}
+    dicts is returned.
+    """
+
+    query = "SELECT id, name, phone, priority FROM humans " \
+            "WHERE line = %s " \
+            "ORDER BY priority ASC, name ASC " \
+
+    with cursor(True, read_only=True) as cur:
+        cur.execute(query, (current_line(), ))
+        humans = cur.fetchall()
+        humans.sort(key=_human_sort_key)
+        return humans
+
+def _human_sort_key(human):
+    """Sort by priority then name, but put disabled humans at the end"""
+    # priority is a smallint, so...
+    priority = human["priority"]
+    return (100000 if priority == 0 else priority, human["name"])
+
+def humans_roster():
+    """
+    Get this line's roster version and humans, in one query
+
+    Returns (version, humans) where humans is as all_humans() returns.
+    """
+
+    query = "SELECT r.version, h.id, h.name, h.phone, h.priority " \
+            "FROM humans_roster AS r " \
+            "LEFT OUTER JOIN humans AS h ON h.line = r.line " \
+            "WHERE r.line = %s"
+
+    with cursor(True, read_only=True) as cur:
+        cur.execute(query, (current_line(), ))
+        rows = cur.fetchall()
+
+    version = rows[0]["version"]
+    humans = [row for row in rows if row["id"] is not None]
+    for human in humans:
+        del human["version"]
+    humans.sort(key=_human_sort_key)
+    return version, humans
+
+class RosterConflict(Exception):
+    """The humans roster changed since the editor loaded it"""
+    pass
+
+def update_human_priorities(version, priorities):
+    """
+    Update the priorities of many of this line's humans in one statement
+
+    priorities should be a dict mapping human id to new priority; version
+    the roster version the edit was based on. The version check, update
+    and re-read of the roster all happen in one query, so the row lock
+    on the line's humans_roster row serialises concurrent editors.
+
+    Returns (new_version, humans, changed) where humans is as all_humans()
+    returns and changed is the number of priorities that actually changed.
+    Raises RosterConflict if version is stale.
+    """
+
+    query = "WITH " \
+            "bump AS ( " \
+            "    UPDATE humans_roster SET version = version + 1 " \
+            "    WHERE line = %s AND version = %s " \
+            "    RETURNING line, version " \
+            "), " \
+            "updated AS ( " \
+            "    UPDATE humans SET priority = v.priority " \
+            "    FROM (VALUES {0}) AS v (id, priority), bump " \
+            "    WHERE humans.id = v.id AND humans.line = bump.line AND " \
+            "        humans.priority != v.priority " \
+            "    RETURNING humans.id, humans.priority " \
+            ") " \
+            "SELECT b.version, h.id, h.name, h.phone, " \
+            "    COALESCE(u.priority, h.priority) AS priority, " \
+            "    u.id IS NOT NULL AS changed " \
+            "FROM bump AS b " \
+            "LEFT OUTER JOIN humans AS h ON h.line = b.line " \
+            "LEFT OUTER JOIN updated AS u ON u.id = h.id"
+
+    items = sorted(priorities.items())
+    if items:
+        values = ','.join(["(%s::INTEGER, %s::SMALLINT)"] * len(items))
+    else:
+        values = "(NULL::INTEGER, NULL::SMALLINT)"
+    params = [current_line(), version] + [x for item in items for x in item]
+
+    with cursor(True) as cur:
+        cur.execute(query.format(values), params)
+        rows = cur.fetchall()
+
+    if not rows:
+        raise RosterConflict
+
+    new_version = rows[0]["version"]
+    humans = [row for row in rows if row["id"] is not None]
+    changed = sum(1 for human in humans if human.pop("changed"))
+    for human in humans:
+        del human["version"]
+    humans.sort(key=_human_sort_key)
+    return new_version, humans, changed
+
+def update_human_priority(human_id, new_priority):
+    """Update the priority column of a single human (of this line)"""
+    query = "UPDATE humans SET priority = %s WHERE id = %s AND line = %s"
+    with cursor() as cur:
+        cur.execute(query, (new_priority, human_id, current_line()))
+        bump_roster_version(cur)
+
+def add_human(name, phone, priority):
+    """Add a human to this line"""
+    query = "INSERT INTO humans (line, name, phone, priority) " \
+            "VALUES (%s, %s, %s, %s)"
+    with cursor() as cur:
+        cur.execute(query, (current_line(), name, phone, priority))
+        bump_roster_version(cur)
+
+def bump_roster_version(cur):
+    """Invalidate editors' views of the roster after changing humans"""
+    cur.execute("UPDATE humans_roster SET version = version + 1 "
+                "WHERE line = %s", (current_line(), ))
+
+def shuffled_humans(seed):
+    """
+    Get all of this line's humans, sorted by priority.
+
+    Humans who aren't on call right now (see OnCallIndex) are left out.
+
+    Humans with equal priorities are shuffled randomly, with an RNG
+    seeded with seed. If TWILIO_ADAPTIVE_DIAL is set, the shuffle is
+    weighted by answer_rate_hint, so humans who usually answer tend to
+    be rung first.
+
+    Returns a list of (priority, name, phone, id) tuples.
+    """
+
+    query = "SELECT priority, name, phone, id, " \
+            "    (SELECT version FROM humans_roster WHERE line = %(l)s) " \
+            "FROM humans " \
+            "WHERE line = %(l)s AND priority > 0 ORDER BY id ASC"
+
+    line = current_line()
+
+    def load():
+        with cursor() as cur:
+            cur.execute(query, {"l": line})
+            return cur.fetchall(), None
+
+    schedule = None if degraded() else shared_schedule.line(line)
+
+    if degraded():
+        # availability windows are ignored: better to ring someone
+        humans = [tuple(human)
+                  for human in snapshot_schedule(line)["humans"]]
+    elif schedule is not None:
+        humans = schedule[1]
+    else:
+        humans = humans_cache.get(load, line)
+
+    if humans and not degraded():
+        excluded = on_call_index(line).excluded(humans[0][4])
+        humans = [(priority, name, phone, i)
+                  for (priority, name, phone, i, version) in humans
+                  if i not in excluded]
+    else:
+        humans = [human[:4] for human in humans]
+
+    if adaptive_dial():
+        stats = human_dial_stats()
+        weight = lambda human_id: answer_rate_hint(stats.get(human_id))
+    else:
+        weight = lambda human_id: 1.0
+
+    # Weighted random order (Efraimidis & Spirakis): sorting by
+    # u ** (1 / w) descending; mapped into (priority, priority + 1)
+    rng = random.Random(seed)
+    humans = [(priority + 0.9 - 0.8 * rng.random() ** (1.0 / weight(i)),
+               name, phone, i)
+              for (priority, name, phone, i) in humans]
+    humans.sort()
+
+    return humans
+
+humans_cache = LocalCache("humans")
+
+# Weekly availability windows are stored as ranges in this week (which
+# starts on a Monday), and repeat every week.
+availability_reference_week = datetime.datetime(2001, 1, 1)
+_week = datetime.timedelta(days=7)
+_weekdays = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+def all_availability():
+    """
+    Get this line's availability windows, sorted by human then time
+
+    A list of {"id": id, "human": human_id, "name": human_name,
+    "weekly": bool, "available": bool, "active_when": range} dicts.
+    """
+
+    query = "SELECT a.id, a.human, h.name, a.weekly, a.available, " \
+            "    a.active_when " \
+            "FROM human_availability AS a " \
+            "JOIN humans AS h ON a.human = h.id " \
+            "WHERE h.line = %s " \
+            "ORDER BY h.name, a.weekly DESC, a.active_when"
+
+    with cursor(True, read_only=True) as cur:
+        cur.execute(query, (current_line(), ))
+        return cur.fetchall()
+
+def add_availability(human_id, weekly, available, active_when):
+    """Add an availability window (if human_id is on this line)"""
+
+    query = "INSERT INTO human_availability " \
+            "(human, weekly, available, active_when) " \
+            "SELECT id, %s, %s, %s FROM humans WHERE id = %s AND line = %s"
+
+    with cursor() as cur:
+        cur.execute(query, (weekly, available, active_when, human_id,
+                            current_line()))
+        bump_roster_version(cur)
+
+def do_delete_availability(window_id):
+    """Delete an availability window (of this line's humans) by id"""
+
+    query = "DELETE FROM human_availability AS a USING humans AS h " \
+            "WHERE a.id = %s AND h.id = a.human AND h.line = %s"
+
+    with cursor() as cur:
+        cur.execute(query, (window_id, current_line()))
+        bump_roster_version(cur)
+
+def parse_weekly_time(value):
+    """
+    Parse "Mon 09:00" into a datetime in availability_reference_week
+
+    Raises ValueError on failure.
+    """
+
+    day, _, time_of_day = value.strip().partition(" ")
+    day = _weekdays.index(day[:3].title())
+    time_of_day = datetime.datetime.strptime(time_of_day.strip(), "%H:%M")
+    return availability_reference_week + datetime.timedelta(
+            days=day, hours=time_of_day.hour, minutes=time_of_day.minute)
+
+@app.template_filter('weekly_time')
+def format_weekly_time(value):
+    """Format a datetime in availability_reference_week as "Mon 09:00" """
+    return "{0} {1:%H:%M}".format(
+            _weekdays[(value - availability_reference_week).days % 7], value)
+
+class OnCallIndex(object):
+    """
+    Which humans can't be rung right now, according to human_availability
+
+    A human is on call unless they are in an 'unavailable' window, or they
+    have 'available' windows but are in none of them. Humans with no
+    windows at all are always on call.
+
+    The set of humans who aren't on call only changes at window boundaries
+    or when the windows are edited (which bumps the humans_roster version),
+    so it is computed once and kept in memory until then. There is one
+    index per line; see on_call_index.
+
+    The (version, valid_until, excluded) state is replaced as a whole, so
+    threads never see a half-updated index. Two threads may rebuild it at
+    once, which is harmless.
+    """
+
+    def __init__(self, line):
+        self.line = line
+        self.invalidate()
+
+    def invalidate(self):
+        self.state = (None, None, frozenset())
+
+    def excluded(self, version):
+        """Get the set of human ids not on call, given the roster version"""
+
+        now = datetime.datetime.now()
+        state_version, valid_until, excluded = self.state
+        if version != state_version or valid_until is None or \
+                now >= valid_until:
+            excluded = self.rebuild(version, now)
+        return excluded
+
+    def rebuild(self, version, now):
+        query = "SELECT a.human, a.weekly, a.available, a.active_when " \
+                "FROM human_availability AS a " \
+                "JOIN humans AS h ON h.id = a.human " \
+                "WHERE h.line = %s"
+
+        with cursor() as cur:
+            cur.execute(query, (self.line, ))
+            windows = cur.fetchall()
+
+        # now, mapped into availability_reference_week
+        monday = (now - datetime.timedelta(days=now.weekday())) \
+                 .replace(hour=0, minute=0, second=0, microsecond=0)
+        week_now = availability_reference_week + (now - monday)
+
+        restricted = set()
+        available = set()
+        unavailable = set()
+        boundaries = [now + datetime.timedelta(days=1)]
+
+        for human, weekly, is_available, active_when in windows:
+            if weekly:
+                # windows may run past the end of the reference week
+                times = (week_now, week_now + _week)
+            else:
+                times = (now, )
+
+            if any(active_when.lower <= t < active_when.upper
+                   for t in times):
+                (available if is_available else unavailable).add(human)
+            if is_available:
+                restricted.add(human)
+
+            for bound in (active_when.lower, active_when.upper):
+                if weekly:
+                    seconds = (bound - week_now).total_seconds() \
+                              % _week.total_seconds()
+                    boundaries.append(now + datetime.timedelta(
+                            seconds=seconds or _week.total_seconds()))
+                elif bound > now:
+                    boundaries.append(bound)
+
+        excluded = frozenset((restricted - available) | unavailable)
+        self.state = (version, min(boundaries), excluded)
+        return excluded
+
+_on_call_indexes = {}
+
+def on_call_index(line=None):
+    """Get the OnCallIndex for line (by default, this request's line)"""
+
+    if line is None:
+        line = current_line()
+    index = _on_call_indexes.get(line)
+    if index is None:
+        with _state_lock:
+            index = _on_call_indexes.setdefault(line, OnCallIndex(line))
+    return index
+
+_message_query = "SELECT m.id, m.line, m.active_when, m.short_name, " \
+                 "       m.web_short_text, m.web_long_text, " \
+                 "       m.call_text, m.forward_to, " \
+                 "       h.name AS forward_name, h.phone AS forward_phone, " \
+                 "       LOCALTIMESTAMP <@ active_when AS active " \
+                 "FROM messages AS m " \
+                 "LEFT OUTER JOIN humans AS h ON m.forward_to = h.id "
+
+def active_message():
+    """
+    Get this line's active message, if it exists.
+
+    Returns a {"id": i, "line": l, "active_when": a, "short_name": s,
+    "web_short_text": wst, "web_long_text": wlt, "call_text": ct,
+    "forward_to": human_id, "forward_name": human_name,
+    "forward_phone": human_phone, "active": bool} dict,
+    or None if there isn't an active message.
+    """
+
+    query1 = _message_query + \
+             "WHERE m.line = %s AND LOCALTIMESTAMP <@ active_when"
+    # when the active message next changes, if it's not the upper bound
+    query2 = "SELECT MIN(LOWER(active_when)) FROM messages " \
+             "WHERE line = %s AND LOWER(active_when) > LOCALTIMESTAMP"
+
+    if degraded():
+        return snapshot_active_message()
+
+    found, message = shared_schedule.active_message()
+    if found:
+        return message
+
+    line = current_line()
+
+    def load():
+        # if caching, read from the primary: a replica may not yet have
+        # the change that invalidated the cache
+        read_only = not active_message_cache.caching()
+
+        with cursor(True, read_only=read_only) as cur:
+            cur.execute(query1, (line, ))
+            if cur.rowcount == 1:
+                message = cur.fetchone()
+            elif cur.rowcount == 0:
+                message = None
+            else:
+                raise AssertionError("cur.rowcount should be 0 or 1")
+
+        if message is not None:
+            return message, message["active_when"].upper
+
+        with cursor(read_only=read_only) as cur:
+            cur.execute(query2, (line, ))
+            return None, cur.fetchone()[0]
+
+    message = active_message_cache.get(load, line)
+    if message is not None:
+        # callers may modify it
+        message = dict(message)
+    return message
+
+active_message_cache = LocalCache("messages")
+
+def messages_count():
+    """Count this line's messages"""
+
+    query = "SELECT COUNT(*) AS count FROM messages WHERE line = %s"
+
+    with cursor(read_only=True) as cur:
+        cur.execute(query, (current_line(), ))
+        return cur.fetchone()[0]
+
+def all_messages(offset, limit=5):
+    """
+    Get all of this line's messages
+
+    Returns a list of messages in the same form as active_message()
+    """
+
+    query = _message_query + \
+            "WHERE m.line = %s " \
+            "ORDER BY active_when " \
+            "OFFSET %s LIMIT %s"
+
+
+    with cursor(True, read_only=True) as cur:
+        cur.execute(query, (current_line(), offset, limit))
+        return cur.fetchall()
+
+def get_message(message_id):
+    """
+    Gets a specific message of this line by its id
+
+    Returns all columns, as a dict, or None.
+    """
+
+    query = "SELECT * FROM messages WHERE id = %s AND line = %s"
+
+    with cursor(True, read_only=True) as cur:
+        cur.execute(query, (message_id, current_line()))
+        return cur.fetchone()
+
+def messages_active_at(times):
+    """
+    Get this line's message that was active at each of times, in one query
+
+    Returns a list in the same order as times, of {"id": i,
+    "short_name": s, "call_text": c, "forward_name": f} dicts, or None
+    where no message was active (so the default message was).
+    """
+
+    times = list(times)
+    if not times:
+        return []
+
+    # one range join, using messages_active_index
+    query = "SELECT t.n, m.id, m.short_name, m.call_text, " \
+            "       h.name AS forward_name " \
+            "FROM UNNEST(%s::TIMESTAMP[]) WITH ORDINALITY AS t (time, n) " \
+            "LEFT OUTER JOIN messages AS m " \
+            "    ON m.line = %s AND m.active_when @> t.time " \
+            "LEFT OUTER JOIN humans AS h ON m.forward_to = h.id " \
+            "ORDER BY t.n"
+
+    with cursor(True, read_only=True) as cur:
+        cur.execute(query, (times, current_line()))
+        rows = cur.fetchall()
+
+    for row in rows:
+        del row["n"]
+    return [row if row["id"] is not None else None for row in rows]
+
+_message_columns = ("short_name", "web_short_text", "web_long_text",
+                    "call_text", "forward_to", "active_when")
+
+def upsert_message(message):
+    """
+    Insert or update a message (depending on whether message["id"] is present)
+
+    message should be a dict in the same form as active_message() returns,
+    minus the 'line', 'active', 'forward_name', 'forward_phone' keys,
+    and with the 'id' key optional. It is on this line.
+
+    Automatically moves this line's intersecting (active_when) messages
+    out of the way,
+    returning a list of affected message dicts in form:
+    {"id": id, "short_name": short_name, "action": action}
+    where action is one of "deleted", "end_earlier", "start_later".
+    """
+
+    query1 = "WITH " \
+             "deleted AS ( " \
+             "    DELETE FROM messages " \
+             "    WHERE {0} active_when <@ %(n)s " \
+             "    RETURNING 'delete'::TEXT AS action, " \
+             "        short_name, active_when "\
+             "), " \
+             "end_earlier AS ( " \
              "    UPDATE messages " \
              "    SET active_when = " \
              "        TSRANGE(LOWER(active_when), LOWER(%(n)s)) " \
@@ -389,10 +2172,10 @@ def upsert_message(message):
              "UNION SELECT action, short_name, active_when FROM start_later " \
              "ORDER BY active_when"
 
-    query1_existing = query1.format("id != %(id)s AND ")
-    query1_new = query1.format("")
+    query1_existing = query1.format("line = %(line)s AND id != %(id)s AND ")
+    query1_new = query1.format("line = %(line)s AND ")
 
-    query2 = "UPDATE messages SET {0} WHERE id = %(id)s" \
+    query2 = "UPDATE messages SET {0} WHERE id = %(id)s AND line = %(line)s" \
              .format(','.join('{0} = %({0})s'.format(c)
                      for c in _message_columns))
     # insert query is in insert_message()
@@ -401,7 +2184,8 @@ def upsert_message(message):
     query1 = query1_new if new else query1_existing
 
     with cursor() as cur:
-        params = {"n": message["active_when"], "id": message.get("id", None)}
+        params = {"n": message["active_when"], "id": message.get("id", None),
+                  "line": current_line()}
         cur.execute(query1, params)
 
         moved_messages = [(action, short_name)
@@ -409,40 +2193,1200 @@ def upsert_message(message):
         if new:
             insert_message(message)
         else:
-            cur.execute(query2, message)
+            cur.execute(query2, dict(message, line=current_line()))
 
     return moved_messages
 
 def insert_message(message):
     """
-    Inserts a message.
+    Inserts a message, on this line.
 
     Unlike upsert_message, doesn't move other messages out of the way,
     and won't update an existing message
     """
 
-    query = "INSERT INTO messages ({0}) VALUES ({1})" \
-             .format(','.join(_message_columns),
-                     ','.join('%({0})s'.format(c)
-                     for c in _message_columns))
+    columns = _message_columns + ("line", )
+    query = "INSERT INTO messages ({0}) VALUES ({1})" \
+             .format(','.join(columns),
+                     ','.join('%({0})s'.format(c) for c in columns))
+
+    with cursor() as cur:
+        cur.execute(query, dict(message, line=current_line()))
+
+def insert_messages(messages):
+    """
+    Inserts several messages in a single statement, on this line.
+
+    Like insert_message, doesn't move other messages out of the way.
+    """
+
+    columns = _message_columns + ("line", )
+    query = "INSERT INTO messages ({0}) VALUES %s" \
+            .format(','.join(columns))
+    template = "({0})".format(','.join('%({0})s'.format(c)
+                                       for c in columns))
+    messages = [dict(message, line=current_line()) for message in messages]
+
+    with cursor() as cur:
+        execute_values(cur, query, messages, template=template,
+                       page_size=max(len(messages), 1))
+
+def do_delete_message(message_id):
+    """Delete message (of this line) by id"""
+    query = "DELETE FROM messages WHERE id = %s AND line = %s"
+    with cursor() as cur:
+        cur.execute(query, (message_id, current_line()))
+
+def check_active_clear(active_when):
+    """Check no messages of this line intersect with active_when"""
+
+    query = "SELECT count(*) FROM messages " \
+            "WHERE line = %s AND active_when && %s"
+
+    with cursor() as cur:
+        cur.execute(query, (current_line(), active_when))
+        return cur.fetchone()[0] == 0
+
+def check_active_clear_many(active_whens):
+    """
+    Check no messages of this line intersect with any of active_whens
+
+    Returns the (sorted) list of ranges in active_whens that do intersect
+    an existing message; an empty list means all clear.
+    """
+
+    query = "SELECT DISTINCT r FROM UNNEST(%s::TSRANGE[]) AS r " \
+            "WHERE EXISTS (SELECT 1 FROM messages " \
+            "              WHERE line = %s AND active_when && r) " \
+            "ORDER BY r"
+
+    with cursor() as cur:
+        cur.execute(query, (list(active_whens), current_line()))
+        return [r for (r, ) in cur.fetchall()]
+
+
+## Degraded mode
+
+# If PostgreSQL is unreachable or too slow, the Twilio views are re-run
+# "degraded": the active message and humans come from a snapshot on local
+# disk (written every SNAPSHOT_INTERVAL seconds while things are OK), and
+# call log lines are held in a per-worker file, to be inserted when the
+# database is back.
+
+def snapshot_enabled():
+    return bool(app.config.get("SNAPSHOT_DIR"))
+
+def degraded():
+    """Is this request being answered without PostgreSQL?"""
+    return flask.has_request_context() and getattr(g, "_degraded", False)
+
+def snapshot_path():
+    return os.path.join(app.config["SNAPSHOT_DIR"], "snapshot.json")
+
+def held_call_log_path(pid=None):
+    name = "held-{0}.jsonl".format(os.getpid() if pid is None else pid)
+    return os.path.join(app.config["SNAPSHOT_DIR"], name)
+
+_snapshot_datetime = "%Y-%m-%d %H:%M:%S"
+
+def _dump_range(r):
+    return [r.lower.strftime(_snapshot_datetime),
+            r.upper.strftime(_snapshot_datetime)]
+
+def _load_range(r):
+    lower, upper = r
+    return DateTimeRange(parse_datetime(lower), parse_datetime(upper),
+                         bounds='[)')
+
+def degradable(view):
+    """
+    Decorate a Twilio view so that it is answered from the snapshot if
+    PostgreSQL fails (psycopg2.OperationalError: unreachable, or a
+    statement exceeding the budget; see connection_budget)
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        except psycopg2.OperationalError:
+            if not snapshot_enabled() or degraded() or \
+                    getattr(g, "_committed_early", False):
+                raise
+            logger.warning("PostgreSQL unavailable; answering %s from "
+                           "snapshot", request.endpoint, exc_info=True)
+            # anything logged so far (in the transaction, or waiting to be
+            # journalled) is discarded, and logged again
+            discard_db_connections()
+            g._journal_lines = []
+            g._degraded = True
+            return view(*args, **kwargs)
+
+    return wrapper
+
+def write_snapshot():
+    """
+    Save the lines, and each line's current and upcoming messages and
+    humans, to disk
+
+    The file is replaced atomically, so readers in other workers see
+    either the old or the new snapshot.
+    """
+
+    query1 = "SELECT id, name, phone FROM lines ORDER BY id"
+    query2 = _message_query + \
+             "WHERE UPPER(active_when) > LOCALTIMESTAMP AND " \
+             "    LOWER(active_when) < LOCALTIMESTAMP + INTERVAL '7 days' " \
+             "ORDER BY active_when"
+    query3 = "SELECT line, priority, name, phone, id FROM humans " \
+             "WHERE priority > 0 ORDER BY id ASC"
+
+    with cursor(True, read_only=True) as cur:
+        cur.execute(query1)
+        lines = cur.fetchall()
+        cur.execute(query2)
+        messages = cur.fetchall()
+    with cursor(read_only=True) as cur:
+        cur.execute(query3)
+        humans = cur.fetchall()
+
+    # JSON object keys are strings
+    schedules = dict((str(line["id"]), {"messages": [], "humans": []})
+                     for line in lines)
+    for message in messages:
+        message["active_when"] = _dump_range(message["active_when"])
+        del message["active"]
+        schedules[str(message["line"])]["messages"].append(message)
+    for line, priority, name, phone, human_id in humans:
+        schedules[str(line)]["humans"].append(
+                (priority, name, phone, human_id))
+
+    snapshot = {"written": time.time(), "lines": lines,
+                "schedules": schedules}
+
+    path = snapshot_path()
+    temp = "{0}.{1}".format(path, os.getpid())
+    with open(temp, "w") as f:
+        json.dump(snapshot, f)
+    os.rename(temp, path)
+
+    g._snapshot = snapshot
+
+def load_snapshot():
+    """Load the snapshot (once per request), or an empty one if missing"""
+
+    if not hasattr(g, "_snapshot"):
+        try:
+            with open(snapshot_path()) as f:
+                g._snapshot = json.load(f)
+        except (IOError, ValueError):
+            logger.error("No usable snapshot in degraded mode",
+                         exc_info=True)
+            g._snapshot = {"written": 0, "lines": [], "schedules": {}}
+
+    return g._snapshot
+
+def snapshot_schedule(line):
+    """Get {"messages": [...], "humans": [...]} for line from the snapshot"""
+    return load_snapshot()["schedules"].get(str(line),
+                                            {"messages": [], "humans": []})
+
+def snapshot_active_message():
+    """As active_message(), but from the snapshot"""
+
+    now = datetime.datetime.now()
+
+    for message in snapshot_schedule(current_line())["messages"]:
+        active_when = _load_range(message["active_when"])
+        if now in active_when:
+            return dict(message, active_when=active_when, active=True)
+
+    return None
+
+def hold_call_log(sid, message, seconds_ago=0):
+    """Append a call log line to this worker's held lines file"""
+
+    when = datetime.datetime.now() - datetime.timedelta(seconds=seconds_ago)
+    line = json.dumps([sid, when.strftime("%Y-%m-%d %H:%M:%S.%f"), message])
+    with open(held_call_log_path(), "a") as f:
+        f.write(line + "\n")
+
+def read_held_call_log(paths=None):
+    """Get held (sid, time, message) lines, from this worker by default"""
+
+    if paths is None:
+        paths = [held_call_log_path()]
+
+    lines = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        sid, when, message = json.loads(line)
+                    except ValueError:
+                        # torn final line from a crash
+                        continue
+                    when = datetime.datetime.strptime(
+                            when, "%Y-%m-%d %H:%M:%S.%f")
+                    lines.append((sid, when, message))
+        except IOError:
+            pass
+    return lines
+
+_held_claims = itertools.count()
+
+def flush_held_call_log():
+    """
+    Insert any workers' held call log lines into the database
+
+    Files are claimed by renaming, so two workers won't insert the same
+    lines; they are committed, on a separate connection, and deleted
+    immediately. If that fails they are renamed back for a later retry,
+    and files claimed by workers that died meanwhile are claimed again.
+    """
+
+    directory = app.config["SNAPSHOT_DIR"]
+    paths = glob.glob(os.path.join(directory, "held-*.jsonl"))
+    for path in glob.glob(os.path.join(directory, "held-*.flushing-*")):
+        if not process_alive(int(path.rsplit("-", 1)[1])):
+            paths.append(path)
+
+    claimed = []
+    for path in paths:
+        name = os.path.basename(path).split(".")[0]
+        claim = os.path.join(directory, "{0}.{1}.flushing-{2}"
+                    .format(name, next(_held_claims), os.getpid()))
+        try:
+            os.rename(path, claim)
+        except OSError:
+            continue
+        claimed.append(claim)
+
+    if not claimed:
+        return
+
+    lines = read_held_call_log(claimed)
+    query = "INSERT INTO call_log (call, time, message) VALUES (%s, %s, %s)"
+
+    try:
+        with separate_connection() as conn:
+            with conn.cursor() as cur:
+                for sid, when, message in lines:
+                    cur.execute(query,
+                                (get_or_add_call(cur, sid), when, message))
+    except:
+        for claim in claimed:
+            retry = "held-retry-{0}-{1}.jsonl" \
+                        .format(os.getpid(), next(_held_claims))
+            os.rename(claim, os.path.join(directory, retry))
+        raise
+
+    for claim in claimed:
+        os.unlink(claim)
+
+    logger.info("Inserted %s held call log lines", len(lines))
+
+@app.after_request
+def maintain_snapshot(response):
+    """
+    After a healthy Twilio or web.json request, refresh the snapshot if it
+    is older than SNAPSHOT_INTERVAL seconds (default 60), and insert any
+    held call log lines
+    """
+
+    if not snapshot_enabled() or degraded() or response.status_code != 200:
+        return response
+    if not (request.endpoint or "").startswith(("twilio_", "web_status")):
+        return response
+
+    try:
+        flush_held_call_log()
+
+        interval = app.config.get("SNAPSHOT_INTERVAL", 60)
+        try:
+            age = time.time() - os.stat(snapshot_path()).st_mtime
+        except OSError:
+            age = None
+        if age is None or age > interval:
+            write_snapshot()
+    except (psycopg2.Error, IOError, OSError):
+        logger.warning("Failed to maintain snapshot", exc_info=True)
+
+    return response
+
+
+## Shared schedule
+
+# One process per host (the schedule_writer.py uWSGI mule) writes the
+# current and upcoming messages and the humans to a compact binary file,
+# SHARED_SCHEDULE_PATH (ideally in /dev/shm). Every worker mmaps it: the
+# file is replaced by rename, so readers need no locks, and notice a new
+# version with one stat() per request. Each version is parsed once per
+# worker, into per-line schedules.
+#
+# Layout: header, then lines, then messages, then humans. Strings are a 2
+# byte length then UTF-8; length 0xFFFF means None. Times are seconds
+# since 1970 of the (naive, UTC) datetimes.
+
+_schedule_magic = b"NOTAMSCH"
+_schedule_format = 2
+# magic, format, generation, written, lines, messages, humans
+_schedule_header = struct.Struct("<8sHIdIII")
+# id, roster version; then name and phone
+_schedule_line = struct.Struct("<iI")
+# line, id, lower, upper, forward_to (-1 for None); then six strings
+_schedule_message = struct.Struct("<iiddi")
+_schedule_message_strings = ("short_name", "web_short_text",
+                             "web_long_text", "call_text",
+                             "forward_name", "forward_phone")
+# line, priority, id; then name and phone
+_schedule_human = struct.Struct("<ihi")
+_schedule_string_length = struct.Struct("<H")
+_schedule_epoch = datetime.datetime(1970, 1, 1)
+
+def _schedule_time(dt):
+    return (dt - _schedule_epoch).total_seconds()
+
+def _schedule_datetime(seconds):
+    return _schedule_epoch + datetime.timedelta(seconds=seconds)
+
+def _pack_string(value):
+    if value is None:
+        return _schedule_string_length.pack(0xFFFF)
+    value = value.encode("utf-8") if not isinstance(value, bytes) else value
+    return _schedule_string_length.pack(len(value)) + value
+
+def _unpack_string(buf, offset):
+    length, = _schedule_string_length.unpack_from(buf, offset)
+    offset += _schedule_string_length.size
+    if length == 0xFFFF:
+        return None, offset
+    value = buf[offset:offset + length].decode("utf-8")
+    return value, offset + length
+
+def write_shared_schedule(conn, generation):
+    """
+    Write SHARED_SCHEDULE_PATH from the database, using connection conn
+
+    Messages active in the next day are included, so that readers can
+    follow transitions by themselves.
+    """
+
+    query1 = "SELECT l.id, r.version, l.name, l.phone " \
+             "FROM lines AS l JOIN humans_roster AS r ON r.line = l.id " \
+             "ORDER BY l.id"
+    query2 = _message_query + \
+             "WHERE UPPER(active_when) > LOCALTIMESTAMP AND " \
+             "    LOWER(active_when) < LOCALTIMESTAMP + INTERVAL '1 day' " \
+             "ORDER BY m.line, active_when"
+    query3 = "SELECT line, priority, name, phone, id " \
+             "FROM humans WHERE priority > 0 ORDER BY line, id ASC"
+
+    with conn.cursor() as cur:
+        cur.execute(query1)
+        lines = cur.fetchall()
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(query2)
+        messages = cur.fetchall()
+    with conn.cursor() as cur:
+        cur.execute(query3)
+        humans = cur.fetchall()
+    conn.rollback()
+
+    parts = [_schedule_header.pack(_schedule_magic, _schedule_format,
+                                   generation, time.time(), len(lines),
+                                   len(messages), len(humans))]
+
+    for line_id, roster_version, name, phone in lines:
+        parts.append(_schedule_line.pack(line_id, roster_version))
+        parts += [_pack_string(name), _pack_string(phone)]
+
+    for m in messages:
+        forward_to = -1 if m["forward_to"] is None else m["forward_to"]
+        parts.append(_schedule_message.pack(
+                m["line"], m["id"], _schedule_time(m["active_when"].lower),
+                _schedule_time(m["active_when"].upper), forward_to))
+        parts += [_pack_string(m[key]) for key in _schedule_message_strings]
+
+    for line, priority, name, phone, human_id in humans:
+        parts.append(_schedule_human.pack(line, priority, human_id))
+        parts += [_pack_string(name), _pack_string(phone)]
+
+    path = app.config["SHARED_SCHEDULE_PATH"]
+    temp = "{0}.{1}".format(path, os.getpid())
+    with open(temp, "wb") as f:
+        f.write(b"".join(parts))
+    os.rename(temp, path)
+
+def run_schedule_writer():
+    """
+    Keep SHARED_SCHEDULE_PATH up to date, forever
+
+    Rewrites every SHARED_SCHEDULE_INTERVAL seconds (default 10), or
+    immediately if CACHE_NOTIFY is on and messages or humans change.
+    """
+
+    interval = app.config.get("SHARED_SCHEDULE_INTERVAL", 10)
+    generation = 0
+    conn = None
+
+    while True:
+        versions = (cache_listener.version("messages"),
+                    cache_listener.version("humans"))
+
+        try:
+            if conn is None:
+                conn = psycopg2.connect(app.config["POSTGRES"])
+            generation += 1
+            write_shared_schedule(conn, generation)
+        except Exception:
+            logger.warning("Failed to write shared schedule", exc_info=True)
+            if conn is not None:
+                conn.close()
+                conn = None
+
+        deadline = time.time() + interval
+        while time.time() < deadline:
+            time.sleep(0.1)
+            if None not in versions and versions != \
+                    (cache_listener.version("messages"),
+                     cache_listener.version("humans")):
+                break
+
+class SharedSchedule(object):
+    """Reads the schedule written by run_schedule_writer, via mmap"""
+
+    def __init__(self):
+        self.map = None
+        self.inode = None
+        self.parsed = (None, None)
+
+    def _buffer(self):
+        """Get the current mapping, or None if missing or too old"""
+
+        path = app.config.get("SHARED_SCHEDULE_PATH")
+        if not path:
+            return None
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        if st.st_ino != self.inode:
+            with open(path, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, fmt = _schedule_header.unpack_from(buf, 0)[:2]
+            if magic != _schedule_magic or fmt != _schedule_format:
+                logger.warning("Bad shared schedule at %s", path)
+                return None
+            # the old mapping stays valid for anyone still reading it
+            self.map, self.inode = buf, st.st_ino
+
+        written = _schedule_header.unpack_from(self.map, 0)[3]
+        # must be well under a day; see active_message
+        max_age = app.config.get("SHARED_SCHEDULE_MAX_AGE", 300)
+        if time.time() - written > max_age:
+            return None
+
+        return self.map
+
+    def read(self):
+        """
+        Get the schedule, or None if unavailable
+
+        Returns {"lines": ({id: line}, {phone: id}) as lines_index(),
+        "schedules": {id: (messages, humans, roster_version)}}, where
+        messages are in the same form as active_message() (without
+        'active'), humans as (priority, name, phone, id, roster_version).
+        """
+
+        buf = self._buffer()
+        if buf is None:
+            return None
+
+        # parse each version once; lookups are then by line
+        inode, schedule = self.parsed
+        if inode != self.inode:
+            schedule = self._parse(buf)
+            self.parsed = (self.inode, schedule)
+        return schedule
+
+    def _parse(self, buf):
+        (magic, fmt, generation, written, n_lines,
+                n_messages, n_humans) = _schedule_header.unpack_from(buf, 0)
+        offset = _schedule_header.size
+
+        lines = []
+        schedules = {}
+        for i in range(n_lines):
+            line_id, roster_version = _schedule_line.unpack_from(buf, offset)
+            offset += _schedule_line.size
+            line = {"id": line_id}
+            line["name"], offset = _unpack_string(buf, offset)
+            line["phone"], offset = _unpack_string(buf, offset)
+            lines.append(line)
+            schedules[line_id] = ([], [], roster_version)
+
+        for i in range(n_messages):
+            line_id, message_id, lower, upper, forward_to = \
+                    _schedule_message.unpack_from(buf, offset)
+            offset += _schedule_message.size
+            message = {"id": message_id, "line": line_id,
+                       "forward_to": None if forward_to == -1 else forward_to,
+                       "active_when": DateTimeRange(
+                           _schedule_datetime(lower),
+                           _schedule_datetime(upper), bounds='[)')}
+            for key in _schedule_message_strings:
+                message[key], offset = _unpack_string(buf, offset)
+            schedules[line_id][0].append(message)
+
+        for i in range(n_humans):
+            line_id, priority, human_id = \
+                    _schedule_human.unpack_from(buf, offset)
+            offset += _schedule_human.size
+            name, offset = _unpack_string(buf, offset)
+            phone, offset = _unpack_string(buf, offset)
+            roster_version = schedules[line_id][2]
+            schedules[line_id][1].append(
+                    (priority, name, phone, human_id, roster_version))
+
+        return {"lines": index_lines(lines), "schedules": schedules}
+
+    def line(self, line):
+        """
+        Get (messages, humans, roster_version) for line, or None if the
+        schedule is unavailable or doesn't have the line (yet)
+        """
+
+        schedule = self.read()
+        if schedule is None:
+            return None
+        return schedule["schedules"].get(line)
+
+    def active_message(self):
+        """
+        Get (True, message) with the active message (or None) as in
+        active_message(), or (False, None) if the schedule is unavailable
+        or doesn't cover now
+        """
+
+        schedule = self.line(current_line())
+        if schedule is None:
+            return False, None
+
+        messages, humans, roster_version = schedule
+        now = datetime.datetime.now()
+
+        for message in messages:
+            if now in message["active_when"]:
+                return True, dict(message, active=True)
+
+        # The schedule includes every message starting in the day after
+        # it was written, and is no older than SHARED_SCHEDULE_MAX_AGE,
+        # so there really is no active message.
+        return True, None
+
+shared_schedule = SharedSchedule()
+
+
+## Web stream
+
+# /web/stream is a Server-Sent Events version of /web.json, for the
+# widget: it sends the current texts, then again whenever they change.
+# Rather than hold a uWSGI worker per viewer, the connections are all held
+# by one single-threaded poll() loop (the web_stream.py uWSGI mule)
+# listening on WEB_STREAM_SOCKET, to which the web server proxies
+# /web/stream unbuffered. It LISTENs for cache_channel to hear of edits,
+# and wakes up for schedule transitions by itself. It streams default_line
+# (other lines' widgets can poll web.json?line=).
+
+_web_stream_headers = b"HTTP/1.1 200 OK\r\n" \
+                      b"Content-Type: text/event-stream\r\n" \
+                      b"Cache-Control: no-cache\r\n" \
+                      b"X-Accel-Buffering: no\r\n" \
+                      b"Connection: close\r\n\r\n" \
+                      b"retry: 10000\n\n"
+_web_stream_not_found = b"HTTP/1.1 404 Not Found\r\n" \
+                        b"Content-Length: 0\r\n" \
+                        b"Connection: close\r\n\r\n"
+_web_stream_keepalive = b": keepalive\n\n"
+
+def web_status_text(message):
+    """Get the (short, long) texts for web.json from active_message()"""
+    if not message:
+        m = "No upcoming launches in the next three days"
+        return m, m
+    else:
+        return message["web_short_text"], message["web_long_text"]
+
+def web_stream_event(short, long):
+    data = json.dumps({"short": short, "long": long})
+    return "data: {0}\n\n".format(data).encode("utf-8")
+
+def listen_web_stream():
+    """Open WEB_STREAM_SOCKET: a unix socket path, or host:port"""
+
+    address = app.config["WEB_STREAM_SOCKET"]
+    if address.startswith("/"):
+        try:
+            os.unlink(address)
+        except OSError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+    else:
+        host, port = address.rsplit(":", 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(port)))
+
+    sock.listen(128)
+    sock.setblocking(False)
+    return sock
+
+class WebStreamClient(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.request = b""
+        self.output = b""
+        self.streaming = False
+        self.closing = False
+
+class WebStream(object):
+    """
+    Serves /web/stream to any number of clients from a single thread
+
+    The texts are re-read from the database on a notification, at the
+    next transition, and every WEB_STREAM_INTERVAL seconds (default 300)
+    as a backstop; clients are only sent an event if they changed.
+    Clients that fall more than WEB_STREAM_BUFFER bytes (default 65536)
+    behind are dropped.
+    """
+
+    query = "SELECT a.web_short_text, a.web_long_text, " \
+            "    EXTRACT(EPOCH FROM " \
+            "        LEAST(UPPER(a.active_when), n.lower) - LOCALTIMESTAMP) " \
+            "FROM (SELECT MIN(LOWER(active_when)) AS lower FROM messages " \
+            "      WHERE line = %(l)s AND " \
+            "          LOWER(active_when) > LOCALTIMESTAMP) AS n " \
+            "LEFT JOIN messages AS a " \
+            "    ON a.line = %(l)s AND LOCALTIMESTAMP <@ a.active_when"
+
+    def __init__(self, server):
+        self.server = server
+        self.poller = select.poll()
+        self.poller.register(server, select.POLLIN)
+        self.clients = {}
+        self.conn = None
+        self.event = None
+        self.next_check = 0
+        self.next_keepalive = 0
+
+    def run(self):
+        keepalive = app.config.get("WEB_STREAM_KEEPALIVE", 30)
+
+        while True:
+            now = time.time()
+            if now >= self.next_check:
+                self.check()
+            if now >= self.next_keepalive:
+                self.broadcast(_web_stream_keepalive)
+                self.next_keepalive = now + keepalive
+
+            wake = min(self.next_check, self.next_keepalive)
+            timeout = int(math.ceil(max(wake - time.time(), 0) * 1000))
+            for fd, events in self.poller.poll(timeout):
+                if fd == self.server.fileno():
+                    self.accept()
+                elif self.conn is not None and fd == self.conn.fileno():
+                    self.notified()
+                elif fd in self.clients:
+                    self.service(self.clients[fd], events)
+
+    def connect(self):
+        self.conn = psycopg2.connect(app.config["POSTGRES"])
+        self.conn.set_session(autocommit=True)
+        with self.conn.cursor() as cur:
+            cur.execute("LISTEN " + cache_channel)
+        self.poller.register(self.conn, select.POLLIN)
+
+    def disconnect(self):
+        logger.warning("Web stream database connection failed",
+                       exc_info=True)
+        if self.conn is not None:
+            try:
+                self.poller.unregister(self.conn)
+                self.conn.close()
+            except (psycopg2.Error, KeyError, ValueError):
+                pass
+            self.conn = None
+        self.next_check = time.time() + 5
+
+    def check(self):
+        """Re-read the texts, and send them to clients if they changed"""
+
+        try:
+            if self.conn is None:
+                self.connect()
+            with self.conn.cursor() as cur:
+                cur.execute(self.query, {"l": default_line})
+                short, long, until = cur.fetchone()
+        except psycopg2.Error:
+            self.disconnect()
+            return
+
+        message = None
+        if short is not None:
+            message = {"web_short_text": short, "web_long_text": long}
+        event = web_stream_event(*web_status_text(message))
+
+        interval = app.config.get("WEB_STREAM_INTERVAL", 300)
+        if until is not None:
+            # active_when bounds are whole seconds; be just after this one
+            interval = min(interval, float(until) + 0.5)
+        self.next_check = time.time() + interval
+
+        if event != self.event:
+            self.event = event
+            self.broadcast(event)
+
+    def notified(self):
+        try:
+            self.conn.poll()
+        except psycopg2.Error:
+            self.disconnect()
+            return
+
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            if cache_tables.get(notify.payload) == "messages":
+                self.next_check = 0
+
+    def accept(self):
+        try:
+            sock, address = self.server.accept()
+        except socket.error:
+            return
+
+        if len(self.clients) >= app.config.get("WEB_STREAM_CLIENTS", 5000):
+            sock.close()
+            return
+
+        sock.setblocking(False)
+        self.clients[sock.fileno()] = WebStreamClient(sock)
+        self.poller.register(sock, select.POLLIN)
+
+    def drop(self, client):
+        del self.clients[client.sock.fileno()]
+        self.poller.unregister(client.sock)
+        client.sock.close()
+
+    def broadcast(self, data):
+        for client in list(self.clients.values()):
+            if client.streaming:
+                self.send(client, data)
+
+    def send(self, client, data):
+        """Queue data for client, and write as much as possible now"""
+
+        client.output += data
+        if len(client.output) > app.config.get("WEB_STREAM_BUFFER", 65536):
+            self.drop(client)
+            return
+
+        try:
+            sent = client.sock.send(client.output,
+                                    getattr(socket, "MSG_NOSIGNAL", 0))
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.drop(client)
+                return
+            sent = 0
+
+        client.output = client.output[sent:]
+        if client.output:
+            self.poller.modify(client.sock, select.POLLIN | select.POLLOUT)
+        elif client.closing:
+            self.drop(client)
+        else:
+            self.poller.modify(client.sock, select.POLLIN)
+
+    def service(self, client, events):
+        if events & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+            self.drop(client)
+            return
+
+        if events & select.POLLOUT:
+            self.send(client, b"")
+            if client.sock.fileno() not in self.clients:
+                return
+
+        if events & select.POLLIN:
+            try:
+                data = client.sock.recv(4096)
+            except socket.error:
+                data = b""
+            if not data:
+                self.drop(client)
+            elif not client.streaming:
+                self.read_request(client, data)
+
+    def read_request(self, client, data):
+        """Read the request's headers; then start streaming, or 404"""
+
+        client.request += data
+        if b"\r\n\r\n" not in client.request:
+            if len(client.request) > 8192:
+                self.drop(client)
+            return
+
+        try:
+            method, target = client.request.split(b" ", 2)[:2]
+        except ValueError:
+            method, target = None, b""
+        path = target.split(b"?", 1)[0]
+
+        if method == b"GET" and path.endswith(b"/web/stream"):
+            client.streaming = True
+            self.send(client, _web_stream_headers + (self.event or b""))
+        else:
+            client.closing = True
+            self.send(client, _web_stream_not_found)
+
+def run_web_stream():
+    """Serve /web/stream on WEB_STREAM_SOCKET, forever"""
+    WebStream(listen_web_stream()).run()
+
+
+## Rate limiting
+
+# Token buckets keyed on the caller's number, checked before touching the
+# database. They live in each worker, or, if RATE_LIMIT_DIR is set (ideally
+# on /dev/shm), in a small hash table in a file that every worker on the
+# host mmaps, locked with lockf for the duration of each update. Keys that
+# were rejected (e.g., call SIDs, so that the status callback can be
+# ignored too, whichever worker gets it) are remembered in the same way.
+#
+# Slot: SHA-1 of the key, tokens, time last updated (0 for an empty slot).
+# Rejected slot: SHA-1 of the key, time remembered (0 for an empty slot).
+
+_rate_slot = struct.Struct("<20sdd")
+_rejected_slot = struct.Struct("<20sd")
+_rate_slots = 4096
+_rate_probes = 8
+
+class RateLimiter(object):
+    """
+    Allows each key a burst of calls, refilled at calls per seconds
+
+    The limit is app.config[setting], as (calls, seconds), or None to
+    disable. Rejections are logged once per key, and summarised when the
+    key is next allowed.
+
+    remember() and rejected() keep track of what was rejected (e.g., which
+    calls), in the same place as the buckets.
+    """
+
+    def __init__(self, name, setting):
+        self.name = name
+        self.setting = setting
+        self.buckets = {}
+        self.rejections = collections.OrderedDict()
+        self.remembered = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.maps = {}
+        self.map_pid = None
+
+    def limit(self):
+        return app.config.get(self.setting)
+
+    def _refill(self, tokens, updated, now):
+        calls, seconds = self.limit()
+        return min(calls, tokens + (now - updated) * calls / float(seconds))
+
+    def _take_local(self, key, now):
+        calls, seconds = self.limit()
+        tokens, updated = self.buckets.get(key, (calls, now))
+        tokens = self._refill(tokens, updated, now)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+
+        if len(self.buckets) > _rate_slots:
+            # forget full buckets; they're the same as new ones
+            for k, (t, u) in list(self.buckets.items()):
+                if self._refill(t, u, now) >= calls:
+                    del self.buckets[k]
+
+        return allowed
+
+    def _shared_map(self, kind="buckets", slot=_rate_slot):
+        """Get (fd, mapping) of a shared table, opening it if needed"""
+
+        if self.map_pid != os.getpid():
+            # (a forked worker's inherited fds and mappings are just left)
+            self.maps = {}
+            self.map_pid = os.getpid()
+
+        if kind not in self.maps:
+            path = os.path.join(app.config["RATE_LIMIT_DIR"],
+                                "{0}.{1}".format(self.name, kind))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            size = slot.size * _rate_slots
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.maps[kind] = (fd, mmap.mmap(fd, size))
+        return self.maps[kind]
+
+    def _remember_shared(self, key, now):
+        fd, buf = self._shared_map("rejected", _rejected_slot)
+        digest = hashlib.sha1(key.encode("utf-8")).digest()
+        start = struct.unpack_from("<I", digest)[0] % _rate_slots
+
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            # the slot already holding key, else the oldest (or empty) one
+            victim = None
+            for i in range(_rate_probes):
+                offset = ((start + i) % _rate_slots) * _rejected_slot.size
+                slot_digest, remembered = \
+                        _rejected_slot.unpack_from(buf, offset)
+                if slot_digest == digest:
+                    victim = (offset, remembered)
+                    break
+                if victim is None or remembered < victim[1]:
+                    victim = (offset, remembered)
+            _rejected_slot.pack_into(buf, victim[0], digest, now)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+    def _forget_shared(self, key):
+        fd, buf = self._shared_map("rejected", _rejected_slot)
+        digest = hashlib.sha1(key.encode("utf-8")).digest()
+        start = struct.unpack_from("<I", digest)[0] % _rate_slots
+
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            for i in range(_rate_probes):
+                offset = ((start + i) % _rate_slots) * _rejected_slot.size
+                slot_digest, remembered = \
+                        _rejected_slot.unpack_from(buf, offset)
+                if slot_digest == digest:
+                    _rejected_slot.pack_into(buf, offset, b"\0" * 20, 0)
+                    return True
+            return False
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+    def _take_shared(self, key, now):
+        calls, seconds = self.limit()
+        fd, buf = self._shared_map()
+        digest = hashlib.sha1(key.encode("utf-8")).digest()
+        start = struct.unpack_from("<I", digest)[0] % _rate_slots
+
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            victim = None
+            for i in range(_rate_probes):
+                slot = (start + i) % _rate_slots
+                offset = slot * _rate_slot.size
+                slot_digest, tokens, updated = \
+                        _rate_slot.unpack_from(buf, offset)
+                if slot_digest == digest:
+                    break
+                if victim is None or updated < victim[1]:
+                    victim = (offset, updated)
+            else:
+                # new key: take an empty or the least recently used slot
+                offset, tokens, updated = victim[0], calls, now
+
+            tokens = self._refill(tokens, updated, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            _rate_slot.pack_into(buf, offset, digest, tokens, now)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+        return allowed
+
+    def allow(self, key):
+        """Take a token for key, returning False if there are none left"""
+
+        if not self.limit():
+            return True
+
+        # (lockf only excludes other processes)
+        with self.lock:
+            now = time.time()
+            if app.config.get("RATE_LIMIT_DIR"):
+                allowed = self._take_shared(key, now)
+            else:
+                allowed = self._take_local(key, now)
 
-    with cursor() as cur:
-        cur.execute(query, message)
+            if allowed:
+                count = self.rejections.pop(key, 0)
+                if count > 1:
+                    logger.warning("Rate limited %s: rejected %s from %s "
+                                   "in all", self.name, count, key)
+            else:
+                count = self.rejections.pop(key, 0) + 1
+                if count == 1:
+                    logger.warning("Rate limiting %s from %s",
+                                   self.name, key)
+                self.rejections[key] = count
+                if len(self.rejections) > 1000:
+                    key, count = self.rejections.popitem(last=False)
+                    logger.warning("Rate limited %s: rejected %s from %s",
+                                   self.name, count, key)
+
+        return allowed
+
+    def remember(self, key):
+        """Note that key (e.g., a call SID) was rejected"""
+
+        with self.lock:
+            if app.config.get("RATE_LIMIT_DIR"):
+                self._remember_shared(key, time.time())
+            else:
+                self.remembered[key] = True
+                while len(self.remembered) > 1000:
+                    self.remembered.popitem(last=False)
 
-def do_delete_message(message_id):
-    """Delete message by id"""
-    query = "DELETE FROM messages WHERE id = %s"
-    with cursor() as cur:
-        cur.execute(query, (message_id, ))
+    def rejected(self, key):
+        """Was key remembered as rejected? (Forgetting it)"""
 
-def check_active_clear(active_when):
-    """Check there are no messages intersecting with active_when"""
+        if not self.limit():
+            return False
 
-    query = "SELECT count(*) FROM messages WHERE active_when && %s"
+        with self.lock:
+            if app.config.get("RATE_LIMIT_DIR"):
+                return self._forget_shared(key)
+            else:
+                return self.remembered.pop(key, False)
+
+call_rate_limiter = RateLimiter("calls", "CALL_RATE_LIMIT")
+sms_rate_limiter = RateLimiter("texts", "SMS_RATE_LIMIT")
+
+
+## Idempotent webhooks
+
+# Twilio retries webhooks that time out or fail to connect. Responses are
+# remembered, keyed on Twilio's idempotency token if it sent one, or else
+# on the call (or message) SID, the URL and the form parameters that
+# matter, in a per-worker LRU and in webhook_responses. A repeat gets the
+# original response, without running the view again. The row is inserted
+# in the view's own transaction, so it exists if and only if the view's
+# effects were committed (unless the view commits early).
+#
+# Twilio's retry usually arrives while the original is still running, so
+# each request holds a (session) advisory lock on its key until the end
+# of the request, even across early commits: a retry waits for it, and
+# then finds the response. If degraded mode's budget runs out first, the
+# retry gets a 503.
+
+_webhook_responses = collections.OrderedDict()
+
+def webhook_key(params):
+    token = request.headers.get("I-Twilio-Idempotency-Token")
+    if token:
+        parts = ["token", token]
+    else:
+        if "MessageSid" in request.form:
+            sid = request.form["MessageSid"]
+        else:
+            sid = get_sid()
+        parts = [sid, request.full_path] + \
+                [request.form.get(p, "") for p in params]
+    return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+def remember_webhook(key, response):
+    with _state_lock:
+        _webhook_responses[key] = response
+        while len(_webhook_responses) > \
+                app.config.get("WEBHOOK_CACHE_SIZE", 1000):
+            _webhook_responses.popitem(last=False)
+
+def remembered_webhook(key):
+    """Get the remembered response for key (marking it used), or None"""
+    with _state_lock:
+        response = _webhook_responses.pop(key, None)
+        if response is not None:
+            _webhook_responses[key] = response
+        return response
+
+def webhook_lock(key):
+    """The advisory lock for a webhook key"""
+    return int(key[:15], 16)
+
+def release_webhook_lock(conn):
+    """Release this request's webhook lock, if any, after committing"""
+    if hasattr(g, "_webhook_lock"):
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (g._webhook_lock, ))
+        conn.commit()
+        del g._webhook_lock
+
+def idempotent(*params):
+    """
+    Decorate a Twilio view, so that Twilio's retries get the original
+    response; params are the form parameters that distinguish requests
+    """
 
-    with cursor() as cur:
-        cur.execute(query, (active_when, ))
-        return cur.fetchone()[0] == 0
+    query1 = "SELECT response FROM webhook_responses WHERE key = %s"
+    query2 = "INSERT INTO webhook_responses (key, created, response) " \
+             "VALUES (%s, LOCALTIMESTAMP, %s) " \
+             "ON CONFLICT (key) DO NOTHING"
+    query3 = "DELETE FROM webhook_responses " \
+             "WHERE created < LOCALTIMESTAMP - INTERVAL '1 day'"
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = webhook_key(params)
+
+            response = remembered_webhook(key)
+            if response is not None:
+                logger.info("Replaying response to repeated %s",
+                            request.endpoint)
+                return response
+
+            if not degraded():
+                with cursor() as cur:
+                    try:
+                        cur.execute("SELECT pg_advisory_lock(%s)",
+                                    (webhook_lock(key), ))
+                    except psycopg2.extensions.QueryCanceledError:
+                        logger.warning("Gave up waiting for the original "
+                                       "%s", request.endpoint)
+                        abort(503)
+                    g._webhook_lock = webhook_lock(key)
+
+                    cur.execute(query1, (key, ))
+                    if cur.rowcount:
+                        response = cur.fetchone()[0]
+                        remember_webhook(key, response)
+                        logger.info("Replaying response to repeated %s",
+                                    request.endpoint)
+                        return response
+
+            response = view(*args, **kwargs)
+
+            if not degraded():
+                with cursor() as cur:
+                    cur.execute(query2, (key, response))
+                    if random.random() < 0.01:
+                        cur.execute(query3)
+            remember_webhook(key, response)
+
+            return response
+        return wrapper
+
+    return decorator
 
 
 ## Misc
@@ -470,11 +3414,17 @@ def csrf_token_input():
             .format(csrf_token())
 
 def check_csrf_token():
-    """Checks that request.form["_csrf_token"] is correct, aborting if not"""
-    if "_csrf_token" not in request.form:
+    """
+    Checks that request.form["_csrf_token"] is correct, aborting if not
+
+    JSON requests may instead send the token in an X-CSRF-Token header.
+    """
+    token = request.form.get("_csrf_token",
+                             request.headers.get("X-CSRF-Token"))
+    if token is None:
         logger.warning("Expected CSRF Token: not present")
         abort(400)
-    if request.form["_csrf_token"] != csrf_token():
+    if token != csrf_token():
         logger.warning("CSRF Token incorrect")
         abort(400)
 
@@ -562,6 +3512,77 @@ def show_which_pages_responsive(page, pages, phone=5, tablet=7, desktop=11):
 
     return [(page, page_class(page)) for page in all_pages]
 
+static_build_dir = os.path.join(app.static_folder, "build")
+_static_manifest = None
+
+def static_manifest():
+    """
+    Load static/build/manifest.json (written by build_static.py), once
+
+    Returns {} if the assets haven't been built, in which case static_url
+    falls back to the unfingerprinted files.
+    """
+
+    global _static_manifest
+
+    if _static_manifest is None:
+        path = app.config.get("STATIC_MANIFEST",
+                              os.path.join(static_build_dir, "manifest.json"))
+        try:
+            with open(path) as f:
+                _static_manifest = json.load(f)
+        except IOError:
+            logger.warning("No static manifest at %s; run build_static.py",
+                           path)
+            _static_manifest = {}
+
+    return _static_manifest
+
+@app.template_global('static_url')
+def static_url(filename, **kwargs):
+    """
+    url_for('static', filename=filename), but fingerprinted if built
+
+    The fingerprinted URL is served by static_build, with far-future
+    caching. This covers the IVR prompts in static/audio too, which
+    build_static.py transcodes to 8 kHz mu-law.
+    """
+
+    built = static_manifest().get(filename)
+    if built is None:
+        return url_for('static', filename=filename, **kwargs)
+    else:
+        return url_for('static_build', filename=built, **kwargs)
+
+_content_encodings = (("br", ".br"), ("gzip", ".gz"))
+
+@app.route("/assets/<path:filename>")
+def static_build(filename):
+    """Serve a fingerprinted asset, precompressed if possible"""
+
+    mimetype = mimetypes.guess_type(filename)[0]
+    encoding = None
+
+    for name, ext in _content_encodings:
+        if name in request.accept_encodings and \
+                os.path.exists(os.path.join(static_build_dir, filename + ext)):
+            encoding = name
+            filename += ext
+            break
+
+    # conditional: ETag/If-None-Match and Range requests (Twilio fetching
+    # prompts) are handled by send_file
+    response = flask.send_from_directory(static_build_dir, filename,
+                                         mimetype=mimetype, conditional=True)
+    # the name changes whenever the content does
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 60 * 60
+    response.headers["Cache-Control"] += ", immutable"
+    response.vary.add("Accept-Encoding")
+    if encoding is not None:
+        response.content_encoding = encoding
+    return response
+
 @app.template_global('datetime_now')
 def datetime_now():
     """Return now(), for templates"""
@@ -702,6 +3723,91 @@ def wizard_checks(active_all):
     else:
         return None
 
+def parse_launch_dates(value):
+    """
+    Parse a campaign's launch dates, one per line, into a sorted list
+
+    Blank lines and duplicates are ignored. Raises ValueError if any line
+    is not a valid datetime, or if there are no dates at all.
+    """
+
+    dates = set(parse_datetime(line.strip())
+                for line in value.splitlines() if line.strip())
+    if not dates:
+        raise ValueError("No launch dates")
+    return sorted(dates)
+
+def campaign_ranges(launch_dates):
+    """
+    Return the active_when ranges to be used by the campaign wizard
+
+    launch_dates must be sorted. Returns a list of
+    (launch_date, active_call_text, active_forward_to) tuples.
+
+    Each launch's ranges are as in wizard_ranges, except that a launch's
+    call text starts no earlier than the end of the previous launch's
+    forwarding, so that backup dates chain into one timeline. If that
+    leaves no time for the call text, active_call_text is None.
+
+    Raises ValueError if two launches' forwarding ranges would overlap.
+    """
+
+    campaign = []
+    last_launch_date = None
+    last_forward_to = None
+
+    for launch_date in launch_dates:
+        active_all, active_call_text, active_forward_to = \
+                wizard_ranges(launch_date)
+
+        if last_forward_to is not None:
+            if active_forward_to.lower < last_forward_to.upper:
+                raise ValueError("Launch dates {0} and {1} are too close "
+                                 "together".format(last_launch_date,
+                                                   launch_date))
+
+            if active_call_text.lower < last_forward_to.upper:
+                if last_forward_to.upper == active_forward_to.lower:
+                    active_call_text = None
+                else:
+                    active_call_text = \
+                            DateTimeRange(last_forward_to.upper,
+                                          active_forward_to.lower,
+                                          bounds='[)')
+
+        campaign.append((launch_date, active_call_text, active_forward_to))
+        last_launch_date = launch_date
+        last_forward_to = active_forward_to
+
+    return campaign
+
+def campaign_checks(campaign):
+    """
+    Checks if it's safe to run the campaign wizard.
+
+    As wizard_checks, but checks every range in the campaign against
+    existing messages in a single query.
+
+    Returns an error message, or None if everything is OK
+    """
+
+    ranges = [r for launch_date, active_call_text, active_forward_to
+                in campaign
+                for r in (active_call_text, active_forward_to)
+                if r is not None]
+
+    if ranges[0].lower < datetime.datetime.now():
+        return "First launch is too close: you'll have to add it manually"
+
+    conflicts = check_active_clear_many(ranges)
+    if conflicts:
+        return "There are messages that intersect with the datetime ranges " \
+               "the wizard would want to use (first: {0} to {1}): you'll " \
+               "have to add these manually" \
+               .format(conflicts[0].lower, conflicts[0].upper)
+
+    return None
+
 def wizard_default_text(launch_date):
     """Default text to populate the message edit form from a launch_date"""
     # http://xkcd.com/1205/ ?
@@ -747,6 +3853,14 @@ def redirect_admin():
 def home():
     return render_template("home.html", message=active_message())
 
+@app.route("/admin/line", methods=["POST"])
+def select_line():
+    line = intbrq(request.form["line"])
+    if line not in all_lines():
+        abort(400)
+    session["line"] = line
+    return redirect(url_for("home"))
+
 @app.route("/admin/log")
 @app.route("/admin/log/<int:page>")
 def log_viewer(page=None):
@@ -771,6 +3885,9 @@ def log_viewer(page=None):
 
     offset = (page - 1) * page_size
     calls = call_log_first_lines(offset, page_size)
+    messages = messages_active_at(c["first_time"] for c in calls)
+    for call, message in zip(calls, messages):
+        call["message"] = message
 
     return render_template("log_viewer.html",
                 calls=calls, pages=pages, page=page)
@@ -786,9 +3903,29 @@ def log_viewer_call(call):
     if not log:
         abort(404)
 
+    message, = messages_active_at([log[0]["time"]])
+
     return render_template("log_viewer_call.html", call=call, sid=sid, log=log,
+                           message=message,
                            return_to=request.args.get("return_to", None))
 
+@app.route("/admin/calls")
+def call_board():
+    with cursor(real_dict_cursor=True, read_only=True) as cur:
+        calls = select_active_calls(cur, current_line())
+    return render_template("call_board.html", calls=calls)
+
+@app.route("/admin/calls/stream")
+def call_board_stream():
+    # holds a worker (thread, greenlet) until it ends; the browser
+    # reconnects, getting every call afresh
+    duration = app.config.get("CALL_BOARD_STREAM_SECONDS", 300)
+    events = call_board_events(app.config["POSTGRES"], current_line(),
+                               duration)
+    return flask.Response(events, mimetype="text/event-stream",
+                          headers={"Cache-Control": "no-cache",
+                                   "X-Accel-Buffering": "no"})
+
 @app.route("/admin/humans", methods=["GET", "POST"])
 def edit_humans():
     # if the update succeeds, redirect so that the method becomes GET and
@@ -800,17 +3937,18 @@ def edit_humans():
     # request's transaction, so the rollback doesn't hit anything unexpected
 
     if request.form.get("edit_priorities", False):
-        changed = 0
+        version = intbrq(request.form["roster_version"])
+        priorities = parse_priorities(request.form)
 
         try:
-            for human in all_humans():
-                field_name = "priority_{0}".format(human["id"])
-                new_priority = intbrq(request.form[field_name])
-                if human["priority"] != new_priority:
-                    update_human_priority(human["id"], new_priority)
-                    changed += 1
+            version, humans, changed = \
+                    update_human_priorities(version, priorities)
 
-        except psycopg2.DataError:
+        except RosterConflict:
+            flash('Someone else changed the humans while you were editing; '
+                  'check the new priorities and try again', 'error')
+
+        except (psycopg2.IntegrityError, psycopg2.DataError):
             connection().rollback()
             logger.warning("PostgreSQL error", exc_info=True)
             abort(400)
@@ -826,6 +3964,41 @@ def edit_humans():
 
             return redirect(url_for(request.endpoint))
 
+    elif request.form.get("add_availability", False):
+        human_id = intbrq(request.form["human"])
+        weekly = request.form["kind"] == "weekly"
+        available = request.form["available"] == "true"
+
+        try:
+            if weekly:
+                lower = parse_weekly_time(request.form["lower"])
+                upper = parse_weekly_time(request.form["upper"])
+                if upper <= lower:
+                    # e.g. Sun 22:00 to Mon 06:00
+                    upper += _week
+            else:
+                lower = parse_datetime(request.form["lower"])
+                upper = parse_datetime(request.form["upper"])
+            if lower >= upper:
+                raise ValueError
+        except ValueError:
+            flash('Invalid availability window', 'error')
+
+        else:
+            try:
+                add_availability(human_id, weekly, available,
+                                 DateTimeRange(lower, upper, bounds='[)'))
+
+            except (psycopg2.IntegrityError, psycopg2.DataError):
+                connection().rollback()
+                logger.warning("PostgreSQL error", exc_info=True)
+                abort(400)
+
+            else:
+                on_call_index().invalidate()
+                flash('Availability window added', 'success')
+                return redirect(url_for(request.endpoint))
+
     elif request.form.get("add_human", False):
         name = request.form["name"]
         phone = request.form["phone"]
@@ -851,7 +4024,7 @@ def edit_humans():
             flash('Human added', 'success')
             return redirect(url_for(request.endpoint))
 
-    humans = all_humans()
+    version, humans = humans_roster()
 
     priorities = set(h["priority"] for h in humans)
 
@@ -866,8 +4039,74 @@ def edit_humans():
 
     return render_template("humans.html",
             humans=humans,
+            roster_version=version,
+            availability=all_availability(),
             lowest_priorities=lowest_priorities)
 
+@app.route("/admin/humans/availability/<int:window>/delete",
+           methods=["POST"])
+def delete_availability(window):
+    check_csrf_token() # since request.form would otherwise be empty
+    do_delete_availability(window)
+    on_call_index().invalidate()
+    flash("Availability window deleted", "success")
+    return redirect(url_for('edit_humans'))
+
+_priority_field_re = re.compile('^priority_([0-9]+)$')
+
+def parse_priorities(form):
+    """
+    Parse {human_id: priority} from priority_<id> fields in form
+
+    Aborts with 400 Bad Request if a priority is not an integer.
+    """
+
+    priorities = {}
+    for key, value in form.items():
+        match = _priority_field_re.match(key)
+        if match:
+            priorities[int(match.group(1))] = intbrq(value)
+    return priorities
+
+@app.route("/admin/humans.json", methods=["GET"])
+def humans_json():
+    version, humans = humans_roster()
+    return jsonify(version=version, humans=humans)
+
+@app.route("/admin/humans/priorities.json", methods=["POST"])
+def edit_priorities_json():
+    """
+    Apply {"version": v, "priorities": {"<id>": p, ...}} in one update
+
+    Responds with the new roster (as /admin/humans.json), or 409 Conflict
+    and the current roster if version is stale.
+    """
+
+    data = request.get_json(force=True, silent=True)
+    try:
+        version = int(data["version"])
+        priorities = dict((int(k), int(v))
+                          for k, v in data["priorities"].items())
+    except (TypeError, KeyError, ValueError, AttributeError):
+        abort(400)
+
+    try:
+        version, humans, changed = \
+                update_human_priorities(version, priorities)
+
+    except RosterConflict:
+        version, humans = humans_roster()
+        response = jsonify(version=version, humans=humans)
+        response.status_code = 409
+        return response
+
+    except (psycopg2.IntegrityError, psycopg2.DataError):
+        connection().rollback()
+        logger.warning("PostgreSQL error", exc_info=True)
+        abort(400)
+
+    return jsonify(version=version, humans=humans, changed=changed)
+
 @app.route("/admin/messages")
 @app.route("/admin/messages/<int:page>")
 def list_messages(page=None):
@@ -1063,6 +4302,83 @@ def wizard_save():
         flash('Messages added successfully', 'success')
         return redirect(url_for('list_messages'))
 
+@app.route("/admin/messages/campaign/start", methods=["POST"])
+def campaign_start():
+    try:
+        launch_dates = parse_launch_dates(request.form["launch_dates"])
+    except ValueError:
+        flash('Invalid datetime', 'error')
+        return redirect(url_for('list_messages'))
+
+    try:
+        campaign = campaign_ranges(launch_dates)
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('list_messages'))
+
+    error = campaign_checks(campaign)
+    if error:
+        flash(error, 'error')
+        return redirect(url_for('list_messages'))
+
+    launches = []
+    for launch_date, active_call_text, active_forward_to in campaign:
+        launch = wizard_default_text(launch_date)
+        launch.update(launch_date=launch_date,
+                      active_call_text=active_call_text,
+                      active_forward_to=active_forward_to)
+        launches.append(launch)
+
+    return render_template("wizard_campaign.html", launches=launches,
+                           humans=all_humans())
+
+@app.route("/admin/messages/campaign/save", methods=["POST"])
+def campaign_save():
+    try:
+        launch_dates = parse_launch_dates(request.form["launch_dates"])
+        campaign = campaign_ranges(launch_dates)
+    except ValueError:
+        abort(400)
+
+    error = campaign_checks(campaign)
+    if error:
+        flash(error, 'error')
+        return redirect(url_for('list_messages'))
+
+    short_name = request.form["short_name"]
+    forward_to = intbrq(request.form["forward_to"])
+
+    messages = []
+    for i, (launch_date, active_call_text, active_forward_to) \
+            in enumerate(campaign):
+        texts = dict((key, request.form["{0}_{1}".format(key, i)])
+                     for key in ("web_short_text", "web_long_text",
+                                 "call_text"))
+
+        base = dict(texts, short_name=short_name)
+        if active_call_text is not None:
+            messages.append(dict(base, forward_to=None,
+                                 active_when=active_call_text))
+        messages.append(dict(base, call_text=None, forward_to=forward_to,
+                             active_when=active_forward_to))
+
+    try:
+        insert_messages(messages)
+    except (psycopg2.IntegrityError, psycopg2.DataError):
+        connection().rollback()
+        logger.warning("PostgreSQL error", exc_info=True)
+        abort(400)
+    except psycopg2.InternalError as e:
+        connection().rollback()
+        if e.pgcode != psycopg2.errorcodes.RAISE_EXCEPTION:
+            raise
+        logger.warning("Forbidden update", exc_info=True)
+        abort(400)
+    else:
+        flash('{0} messages added successfully'.format(len(messages)),
+              'success')
+        return redirect(url_for('list_messages'))
+
 @app.route("/admin/message/<int:message>/delete", methods=["POST"])
 def delete_message(message):
     check_csrf_token() # since request.form would otherwise be empty
@@ -1086,36 +4402,65 @@ def delete_message(message):
 
 @app.route("/heartbeat")
 def heartbeat():
-    with cursor() as cur:
+    with cursor(read_only=True) as cur:
         cur.execute("SELECT TRUE")
         assert cur.fetchone()
     return "uWSGI is alive and PostgreSQL is OK"
 
 @app.route('/web.json')
 def web_status():
-    message = active_message()
-    if not message:
-        m = "No upcoming launches in the next three days"
-        return jsonify(short=m, long=m)
-    else:
-        return jsonify(short=message["web_short_text"],
-                       long=message["web_long_text"])
+    short, long = web_status_text(active_message())
+    return jsonify(short=short, long=long)
 
 
 ## Twilio URLS
 
 @app.route('/twilio/sms', methods=["POST"])
+@degradable
+@idempotent()
 def twilio_sms():
     sms_from = request.form["From"]
     sms_msg = request.form["Body"]
     logger.info("SMS From %s: %r", sms_from, sms_msg)
 
     r = twiml.Response()
+
+    if sms_rate_limiter.allow(sms_from):
+        reply = sms_reply_text()
+        r.message(reply)
+    else:
+        reply = None
+
+    log_sms(sms_from, sms_msg.encode('ascii', 'replace'), reply)
     return str(r)
 
+# line -> (time, reply)
+_sms_replies = {}
+
+def sms_reply_text():
+    """
+    The reply to texts: web.json's short text (for the line texted)
+
+    Unless the message cache is kept coherent by CACHE_NOTIFY, it is
+    re-read at most every SMS_CACHE_TTL seconds (default 30) per worker.
+    """
+
+    ttl = app.config.get("SMS_CACHE_TTL", 30)
+    cached = _sms_replies.get(current_line())
+    if not active_message_cache.caching() and cached is not None and \
+            time.time() - cached[0] < ttl:
+        return cached[1]
+
+    short, long = web_status_text(active_message())
+    _sms_replies[current_line()] = (time.time(), short)
+    return short
+
 @app.route('/twilio/call/start', methods=["POST"])
+@degradable
+@idempotent()
 def twilio_call_start():
     call_log("Call started; from {0}".format(request.form["From"]))
+    record_call_line()
 
     message = active_message()
     r = twiml.Response()
@@ -1127,29 +4472,32 @@ def twilio_call_start():
         call_log("Forwarding call straight to {0!r} on {1}"
             .format(name, phone))
 
-        pickup_url = url_for("twilio_call_forward_pickup",
-                             parent_sid=get_sid())
         d = r.dial(action=url_for("twilio_call_forward_ended"),
                    callerId=request.form["To"])
-        d.number(phone, url=url_for("twilio_call_forward_pickup"))
+        if whisper_pickup():
+            pickup_url = url_for("twilio_call_forward_pickup",
+                                 parent_sid=get_sid())
+            d.number(phone, url=pickup_url)
+        else:
+            d.number(phone)
 
     else:
         # This is the information phone number for the Cambridge University
         # Spaceflight NOTAM.
-        r.play(url_for('static', filename='audio/greeting.wav'))
+        r.play(static_url('audio/greeting.wav'))
         r.pause(length=1)
 
         if not message:
             call_log("Saying 'no launches in the next three days' "
                      "and offering options")
             # We are not planning any launches in the next three days.
-            r.play(url_for('static', filename='audio/none_three_days.wav'))
+            r.play(static_url('audio/none_three_days.wav'))
         else:
             call_text = message["call_text"]
             call_log("Introducing robot and saying {0!r}".format(call_text))
             # You will shortly hear an automated message detailing the
             # approximate time of an upcoming launch that we are planning.
-            r.play(url_for('static', filename='audio/robot_intro.wav'))
+            r.play(static_url('audio/robot_intro.wav'))
             r.pause(length=1)
             r.say(call_text)
 
@@ -1158,16 +4506,73 @@ def twilio_call_start():
 
     return str(r)
 
+# line -> (time, TwiML)
+_rate_limited_twiml = {}
+
+def rate_limited_twiml():
+    """
+    TwiML for rate limited callers: the message, but no options
+
+    Built at most once a minute per line per worker, and not logged.
+    """
+
+    cached = _rate_limited_twiml.get(current_line())
+    if cached is not None and time.time() - cached[0] < 60:
+        return cached[1]
+
+    message = active_message()
+    r = twiml.Response()
+    r.play(static_url('audio/greeting.wav'))
+    r.pause(length=1)
+
+    if not message:
+        r.play(static_url('audio/none_three_days.wav'))
+    elif message["forward_to"]:
+        # no humans for them: "please try the alternative phone number"
+        r.play(static_url('audio/humans_fail.wav'))
+    else:
+        r.play(static_url('audio/robot_intro.wav'))
+        r.pause(length=1)
+        r.say(message["call_text"])
+
+    r.pause(length=1)
+    r.hangup()
+
+    _rate_limited_twiml[current_line()] = (time.time(), str(r))
+    return str(r)
+
+@app.before_request
+def rate_limit_calls():
+    """Answer over-limit callers before the view (or anything) runs"""
+
+    if request.endpoint != "twilio_call_start":
+        return None
+    if call_rate_limiter.allow(request.form["From"]):
+        return None
+
+    try:
+        response = rate_limited_twiml()
+    except psycopg2.OperationalError:
+        logger.warning("Can't rate limit without PostgreSQL", exc_info=True)
+        discard_db_connections()
+        return None
+
+    # so that its status callback is ignored too
+    call_rate_limiter.remember(get_sid())
+    return response
+
 def twilio_options(r):
     g = r.gather(action=url_for("twilio_call_gathered"),
                  timeout=30, numDigits=1)
     # Hopefully this automated message has answered your question, but if not,
     # please press 2 to be forwarded to a human. Otherwise, either hang up or
     # press 1 to end the call.
-    g.play(url_for('static', filename='audio/options.wav'))
+    g.play(static_url('audio/options.wav'))
     r.redirect(url_for('twilio_call_gather_failed'))
 
 @app.route('/twilio/call/gathered', methods=["POST"])
+@degradable
+@idempotent("Digits")
 def twilio_call_gathered():
     d = request.form["Digits"]
     r = twiml.Response()
@@ -1175,13 +4580,22 @@ def twilio_call_gathered():
     if d == "1":
         call_log("Hanging up (pressed 1)")
 
+    elif d == "2" and not admit_human_forward():
+        call_log("Humans busy (pressed 2); queueing")
+        r.play(static_url('audio/forwarding.wav'))
+        r.pause(length=1)
+        line = current_line()
+        r.enqueue(forward_queue.format(line),
+                  waitUrl=url_for("twilio_call_queue_wait", line=line),
+                  action=url_for("twilio_call_queue_left", line=line))
+
     elif d == "2":
         seed = random.getrandbits(32)
         call_log("Trying humans (pressed 2); seed {0!r}".format(seed))
         # Forwarding. In the event that the first society member contacted is
         # in a lecture or otherwise unavailable, a second member will be
         # phoned. This could take a minute or two.
-        r.play(url_for('static', filename='audio/forwarding.wav'))
+        r.play(static_url('audio/forwarding.wav'))
         r.pause(length=1)
         # call_human(seed, 0)
         twilio_dial(r, seed, 0)
@@ -1192,28 +4606,178 @@ def twilio_call_gathered():
 
     return str(r)
 
+@app.route('/twilio/call/queue/wait', methods=["POST"])
+@degradable
+def twilio_call_queue_wait():
+    # Twilio fetches this repeatedly while the caller waits in the queue,
+    # until it says Leave, whereupon it goes to twilio_call_queue_left
+    r = twiml.Response()
+    max_wait = app.config.get("TWILIO_QUEUE_MAX_WAIT", 600)
+
+    if intbrq(request.form["QueueTime"]) > max_wait:
+        end_human_forward()
+        r.leave()
+    elif admit_human_forward(queued=True):
+        r.leave()
+    else:
+        # (there is no separate hold recording)
+        r.play(static_url('audio/forwarding.wav'))
+        r.pause(length=5)
+
+    return str(r)
+
+@app.route('/twilio/call/queue/left', methods=["POST"])
+@degradable
+@idempotent("QueueResult")
+def twilio_call_queue_left():
+    result = request.form["QueueResult"]
+    waited = request.form.get("QueueTime", "?")
+    r = twiml.Response()
+
+    if result == "leave" and human_forward_started():
+        seed = random.getrandbits(32)
+        call_log("Trying humans (queued for {0} seconds); seed {1!r}"
+                    .format(waited, seed))
+        twilio_dial(r, seed, 0)
+
+    elif result == "leave":
+        call_log("Queued for too long ({0} seconds): apologising and "
+                 "hanging up".format(waited))
+        r.play(static_url('audio/humans_fail.wav'))
+        r.pause(length=1)
+        r.hangup()
+
+    else:
+        call_log("Left queue after {0} seconds: {1}".format(waited, result))
+        end_human_forward()
+        r.hangup()
+
+    return str(r)
+
 @app.route('/twilio/call/gather_failed', methods=["POST"])
+@degradable
+@idempotent()
 def twilio_call_gather_failed():
     call_log("Gather failed - no keys pressed; hanging up")
     r = twiml.Response()
     r.hangup()
     return str(r)
 
+def ring_group(humans, index):
+    """
+    Pick the humans to ring at once, starting from humans[index]
+
+    Up to TWILIO_RING_GROUP_SIZE (default 1: one at a time) consecutive
+    humans with the same priority as humans[index] are rung together.
+    humans should be from shuffled_humans. Raises IndexError if index is
+    past the end of humans.
+    """
+
+    size = app.config.get("TWILIO_RING_GROUP_SIZE", 1)
+    priority = int(humans[index][0])
+
+    group = []
+    for human in humans[index:index + size]:
+        if int(human[0]) != priority:
+            break
+        group.append(human)
+    return group
+
+def attempts_name(index, count):
+    """Describe attempts index to index + count - 1, for the call log"""
+    if count == 1:
+        return "attempt {0}".format(index)
+    else:
+        return "attempts {0}-{1}".format(index, index + count - 1)
+
 def twilio_dial(r, seed, index):
-    priority, name, phone = shuffled_humans(seed)[index]
+    """
+    Ring the group starting at attempt index, or, if there are no humans
+    left (or none on call at all), apologise and hang up
+    """
+
+    humans = shuffled_humans(seed)
+    if index >= len(humans):
+        if index == 0:
+            call_log("Humans exhausted (none on call): apologising and "
+                     "hanging up")
+        else:
+            call_log("Humans exhausted: apologising and hanging up")
+        end_human_forward()
+        # Unfortunately we failed to contact any members.
+        # Please try the alternative phone number on the NOTAM
+        r.play(static_url('audio/humans_fail.wav'))
+        r.pause(length=1)
+        r.hangup()
+        return
 
-    call_log("Attempt {0}: {1!r} on {2}".format(index, name, phone))
+    group = ring_group(humans, index)
+
+    call_log("{0}: {1}".format(attempts_name(index, len(group)).capitalize(),
+             ", ".join("{0!r} on {1}".format(name, phone)
+                       for priority, name, phone, human_id in group)))
+    record_dials(human_id for priority, name, phone, human_id in group)
+
+    dial_args = {}
+    if adaptive_dial():
+        stats = human_dial_stats()
+        dial_args["timeout"] = max(dial_timeout(stats.get(human_id))
+                                   for priority, name, phone, human_id
+                                   in group)
 
     # Make callerId be our Twilio number so people know why they're being
     # called at 7am before they pick up
-    pickup_url = url_for("twilio_call_human_pickup", seed=seed, index=index,
-                         parent_sid=get_sid())
-    d = r.dial(action=url_for("twilio_call_human_ended",
-                              seed=seed, index=index),
-               callerId=request.form["To"])
-    d.number(phone, url=pickup_url)
+    # Twilio connects the first number in the Dial to answer, and hangs up
+    # on the others.
+    action_url = url_for("twilio_call_human_ended", seed=seed, index=index,
+                         n=len(group))
+    d = r.dial(action=action_url, callerId=request.form["To"], **dial_args)
+
+    for i, (priority, name, phone, human_id) in enumerate(group, index):
+        pickup_url = url_for("twilio_call_human_pickup", seed=seed,
+                             index=i, human=human_id, parent_sid=get_sid())
+        if whisper_pickup():
+            d.number(phone, url=pickup_url)
+        elif len(group) > 1:
+            # The Dial action doesn't say which number answered, so find
+            # out asynchronously, off the critical path
+            d.number(phone, statusCallback=pickup_url,
+                     statusCallbackEvent="answered")
+        else:
+            d.number(phone)
+
+def whisper_pickup():
+    """
+    Should dialled numbers fetch a pickup URL before being connected?
+
+    The pickup URL is only used for logging, but Twilio waits for it
+    before bridging the call. If TWILIO_WHISPER_PICKUP is False, no URL
+    is given and log_dial_pickup works out when the human picked up from
+    the Dial action's parameters instead.
+    """
+    return app.config.get("TWILIO_WHISPER_PICKUP", True)
+
+def log_dial_pickup(what):
+    """
+    Log that what picked up, if not already logged by a pickup URL
+
+    Called from Dial action URLs. DialCallDuration is the length of the
+    bridged call, so the pickup is back-dated by that much to keep the
+    call log in order. Returns that duration if it logged the pickup,
+    else None.
+    """
+
+    if whisper_pickup():
+        return
+
+    duration = request.form.get("DialCallDuration")
+    if request.form["DialCallStatus"] == "completed" and duration:
+        call_log("{0} picked up".format(what), seconds_ago=int(duration))
+        return int(duration)
 
 @app.route('/twilio/call/human/<int:seed>/<int:index>', methods=["POST"])
+@degradable
+@idempotent()
 def twilio_call_human(seed, index):
     r = twiml.Response()
     twilio_dial(r, seed, index)
@@ -1221,50 +4785,63 @@ def twilio_call_human(seed, index):
 
 @app.route("/twilio/call/human/<int:seed>/<int:index>/pickup",
            methods=["POST"])
+@degradable
+@idempotent()
 def twilio_call_human_pickup(seed, index):
     # This URL is hit before the called party is connected to the call
-    # Just use it for logging
+    # (or, for ring groups without TWILIO_WHISPER_PICKUP, as a status
+    # callback once they answer). Just use it for logging
     call_log("Human (attempt {0}) picked up".format(index))
+    if "human" in request.args:
+        record_dial_answered(intbrq(request.args["human"]))
     r = twiml.Response()
     return str(r)
 
 @app.route("/twilio/call/human/<int:seed>/<int:index>/end", methods=["POST"])
+@degradable
+@idempotent("DialCallStatus")
 def twilio_call_human_ended(seed, index):
     # This URL is hit when the Dial verb finishes
 
+    # n is the size of the ring group that was dialled
+    count = intbrq(request.args.get("n", 1))
+    attempts = attempts_name(index, count)
     status = request.form["DialCallStatus"]
     r = twiml.Response()
 
+    if count == 1:
+        # otherwise the pickup URL is always used as a status callback
+        duration = log_dial_pickup("Human ({0})".format(attempts))
+        if duration is not None:
+            record_dial_answered(seconds_ago=duration)
+    record_dials_ended(status)
+
     if status == "completed":
-        call_log("Dial (attempt {0}) completed successfully; hanging up"
-                    .format(index))
+        call_log("Dial ({0}) completed successfully; hanging up"
+                    .format(attempts))
+        end_human_forward()
         r.hangup()
 
     else:
-        call_log("Dialing human (attempt {0}) failed: {1}"
-                    .format(index, status))
-
-        try:
-            twilio_dial(r, seed, index + 1)
-        except IndexError:
-            call_log("Humans exhausted: apologising and hanging up")
-            # Unfortunately we failed to contact any members.
-            # Please try the alternative phone number on the NOTAM
-            r.play(url_for('static', filename='audio/humans_fail.wav'))
-            r.pause(length=1)
-            r.hangup()
+        call_log("Dialing human ({0}) failed: {1}".format(attempts, status))
+        twilio_dial(r, seed, index + count)
 
     return str(r)
 
 @app.route("/twilio/call/forward/pickup", methods=["POST"])
+@degradable
+@idempotent()
 def twilio_call_forward_pickup():
     call_log("Forwarded call picked up")
     r = twiml.Response()
     return str(r)
 
 @app.route("/twilio/call/forward/ended", methods=["POST"])
+@degradable
+@idempotent("DialCallStatus")
 def twilio_call_forward_ended():
     status = request.form["DialCallStatus"]
+    log_dial_pickup("Forwarded call")
     if status == "completed":
         call_log("Forwarded call completed successfully. Hanging up.")
     else:
@@ -1275,6 +4852,8 @@ def twilio_call_forward_ended():
     return str(r)
 
 @app.route("/twilio/call/status_callback", methods=["POST"])
+@degradable
+@idempotent("CallStatus")
 def twilio_call_ended():
     number = request.form["From"]
     duration = request.form["CallDuration"]
@@ -1283,13 +4862,104 @@ def twilio_call_ended():
     # Check that this is sane, it's going in the Subject header
     assert basic_phone_re.match(number)
 
-    call_log("Call from {0} ended after {1} seconds with status '{2}'"
-                .format(number, duration, status))
+    if call_rate_limiter.rejected(get_sid()):
+        return "OK"
+
+    if not degraded():
+        report = reclaim_call_report()
+        if report is not None:
+            # the call was logged and ended the first time
+            logger.info("Duplicate status callback for %s", get_sid())
+            if report:
+                email_call_report(*report)
+            return "OK"
+
+    lines = get_call_log_for_sid()
+
+    message = "Call from {0} ended after {1} seconds with status '{2}'" \
+                .format(number, duration, status)
+    call_log(message)
+    end_human_forward()
+    end_active_call(message)
+    lines.append((datetime.datetime.now(), message))
+
+    call_log_str = format_call_report(lines)
+    urgent = any(message.startswith(urgent_call_log_prefixes)
+                 for time, message in lines)
+
+    if degraded():
+        email("Call from {0}".format(number), call_log_str)
+        return "OK"
+
+    send_now = urgent or not email_digest_minutes()
+    call_id = add_call_report(number, call_log_str, urgent, send_now)
 
-    fmt = lambda time, message: \
-            "{0} {1}".format(time.strftime("%H:%M:%S"), message)
-    lines = (fmt(time, message) for time, message in get_call_log_for_sid())
-    call_log_str = "\n".join(lines)
-    email("Call from {0}".format(number), call_log_str)
+    if call_id is None:
+        # a concurrent retry got there first
+        logger.info("Duplicate status callback for %s", get_sid())
+    elif send_now:
+        email_call_report(call_id, number, call_log_str)
 
     return "OK"
+
+
+## Warm-up
+
+def warm_up():
+    """
+    Do everything that would otherwise slow down a worker's first request
+
+    Call this in each worker as it starts: notam.wsgi does so from a uWSGI
+    postfork hook. It creates the Twilio validator, opens POSTGRES_POOL
+    connections, compiles every template (with JINJA_CACHE_DIR, via a
+    bytecode cache that survives restarts) and loads the static manifest
+    and each line's caches behind active_message and shuffled_humans. The
+    timings, including how long importing this module took, are logged.
+    Failures are logged, not raised: the worker still starts, and the
+    first request does what's left.
+    """
+
+    timings = [("imports", _import_seconds)]
+
+    def step(name, function):
+        start = time.time()
+        try:
+            function()
+        except Exception:
+            logger.warning("Warm-up: %s failed", name, exc_info=True)
+        timings.append((name, time.time() - start))
+
+    def open_connections():
+        pool = connection_pool("POSTGRES")
+        if pool is not None:
+            conns = [pool.getconn()
+                     for i in range(app.config["POSTGRES_POOL"])]
+            for conn in conns:
+                pool.putconn(conn)
+
+    def compile_templates():
+        for name in app.jinja_env.list_templates():
+            try:
+                app.jinja_env.get_template(name)
+            except jinja2.TemplateError:
+                logger.warning("Warm-up: template %s failed", name,
+                               exc_info=True)
+
+    def prime_caches():
+        with app.test_request_context():
+            for line in all_lines():
+                g._line = line
+                active_message()
+                shuffled_humans(0)
+            if adaptive_dial():
+                human_dial_stats()
+
+    step("validator", setup_configured_globals)
+    step("connections", open_connections)
+    step("templates", compile_templates)
+    step("static manifest", static_manifest)
+    step("caches", prime_caches)
+
+    logger.info("Warm-up (pid %s): %s", os.getpid(),
+                ", ".join("{0} {1:.3f}s".format(name, seconds)
+                          for name, seconds in timings))
@@ -0,0 +1,11 @@
+"""
+uWSGI mule that keeps the shared schedule (SHARED_SCHEDULE_PATH) current
+
+The mule is forked from the uWSGI master after notam.wsgi has configured
+the app, so importing notam here gets the configured app.
+"""
+
+from notam import app, run_schedule_writer
+
+if app.config.get("SHARED_SCHEDULE_PATH"):
+    run_schedule_writer()
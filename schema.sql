@@ -1,26 +1,64 @@
 \set ON_ERROR_STOP
 
+-- for messages' per-line exclusion constraint and index
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+DROP TABLE IF EXISTS active_calls;
+DROP TABLE IF EXISTS sms_log;
+DROP TABLE IF EXISTS webhook_responses;
+DROP TABLE IF EXISTS human_forwards;
+DROP TABLE IF EXISTS call_reports;
+DROP TABLE IF EXISTS human_dials;
+DROP TABLE IF EXISTS human_availability;
 DROP TABLE IF EXISTS call_log;
 DROP TABLE IF EXISTS calls;
 DROP TABLE IF EXISTS messages;
 DROP TABLE IF EXISTS humans;
+DROP TABLE IF EXISTS humans_roster;
+DROP TABLE IF EXISTS lines;
 
+DROP FUNCTION IF EXISTS notify_cache() CASCADE;
+DROP FUNCTION IF EXISTS notify_call_board() CASCADE;
+DROP FUNCTION IF EXISTS lines_add_roster() CASCADE;
 DROP FUNCTION IF EXISTS messages_past_insert() CASCADE;
 DROP FUNCTION IF EXISTS messages_past_update() CASCADE;
 DROP FUNCTION IF EXISTS messages_past_delete() CASCADE;
 
+-- each line has its own messages and humans. Calls to a number not listed
+-- here are answered as line 1
+CREATE TABLE lines (
+    id SERIAL,
+    name VARCHAR(50) NOT NULL UNIQUE CHECK (name != ''),
+    -- the Twilio number (as in the To parameter)
+    phone VARCHAR(25) UNIQUE CHECK (phone ~ '^\+[0-9]+$'),
+
+    PRIMARY KEY (id)
+);
+
+INSERT INTO lines (name) VALUES ('CUSF');
+
 CREATE TABLE calls (
     id SERIAL,
     sid VARCHAR(120) NOT NULL UNIQUE CHECK (sid != ''),
+    -- set when the call starts; calls first seen elsewhere (e.g., held
+    -- call log lines) may be left on line 1
+    line INTEGER NOT NULL DEFAULT 1 REFERENCES lines (id),
 
     PRIMARY KEY (id)
 );
 
+CREATE INDEX calls_line_index ON calls (line, id);
+-- for query:
+--   SELECT ... FROM calls JOIN call_log ... WHERE line = %s ORDER BY call;
+
 CREATE TABLE call_log (
     id SERIAL,
     call INTEGER REFERENCES calls (id),
     time TIMESTAMP NOT NULL,
     message VARCHAR(500) NOT NULL CHECK (message != ''),
+    -- set for lines inserted from a CALL_LOG_JOURNAL_DIR journal, so that
+    -- re-inserting them is a no-op
+    journal_key VARCHAR(60) UNIQUE,
 
     PRIMARY KEY (id)
 );
@@ -31,25 +69,178 @@ CREATE INDEX call_log_single_call_log_index ON call_log (call, time, id);
 
 CREATE TABLE humans (
     id SERIAL,
-    name VARCHAR(50) NOT NULL UNIQUE CHECK (name != ''),
-    phone VARCHAR(25) NOT NULL UNIQUE CHECK (phone ~ '^\+[0-9]+$'),
+    line INTEGER NOT NULL REFERENCES lines (id),
+    name VARCHAR(50) NOT NULL CHECK (name != ''),
+    phone VARCHAR(25) NOT NULL CHECK (phone ~ '^\+[0-9]+$'),
     -- priority = 0: disabled; otherwise lowest is first.
     priority SMALLINT NOT NULL CHECK (priority >= 0),
 
+    PRIMARY KEY (id),
+    UNIQUE (line, name),
+    UNIQUE (line, phone),
+    -- so that messages can only forward to their own line's humans
+    UNIQUE (id, line)
+);
+
+CREATE TABLE human_availability (
+    id SERIAL,
+    human INTEGER NOT NULL REFERENCES humans (id),
+    -- weekly windows lie in the week starting Monday 2001-01-01, possibly
+    -- running over into the next, and repeat every week
+    weekly BOOLEAN NOT NULL,
+    -- FALSE: unavailable (e.g. exams) during the window. A human with
+    -- available windows is only rung during them.
+    available BOOLEAN NOT NULL,
+    active_when TSRANGE NOT NULL,
+
+    PRIMARY KEY (id),
+    CONSTRAINT active_when_finite
+        CHECK (LOWER_INF(active_when) = FALSE AND
+               UPPER_INF(active_when) = FALSE AND
+               ISEMPTY(active_when) = FALSE),
+    CONSTRAINT weekly_in_reference_week
+        CHECK (weekly = FALSE OR
+               active_when <@ TSRANGE('2001-01-01', '2001-01-15'))
+);
+
+-- a row per line; bumped on every change to the line's humans so that
+-- concurrent editors can detect that their view of the roster is stale
+CREATE TABLE humans_roster (
+    line INTEGER NOT NULL REFERENCES lines (id),
+    version INTEGER NOT NULL,
+
+    PRIMARY KEY (line)
+);
+
+CREATE FUNCTION lines_add_roster()
+    RETURNS TRIGGER AS
+    $$
+        BEGIN
+            INSERT INTO humans_roster (line, version) VALUES (NEW.id, 1);
+            RETURN NULL;
+        END
+    $$
+    LANGUAGE plpgsql;
+
+CREATE TRIGGER lines_add_roster_trigger
+    AFTER INSERT
+    ON lines
+    FOR EACH ROW EXECUTE PROCEDURE lines_add_roster();
+
+INSERT INTO humans_roster (line, version) VALUES (1, 1);
+
+CREATE TABLE human_dials (
+    id SERIAL,
+    call INTEGER NOT NULL REFERENCES calls (id),
+    human INTEGER NOT NULL REFERENCES humans (id),
+    dialled TIMESTAMP NOT NULL,
+    answered TIMESTAMP CHECK (answered IS NULL OR answered >= dialled),
+    -- the DialCallStatus; NULL while ringing
+    status VARCHAR(20),
+
     PRIMARY KEY (id)
 );
 
+CREATE INDEX human_dials_call_index ON human_dials (call) WHERE status IS NULL;
+-- for query:
+--   UPDATE human_dials SET ... WHERE call = %s AND status IS NULL;
+CREATE INDEX human_dials_stats_index ON human_dials (dialled);
+-- for the last 90 days' stats in human_dial_stats()
+
+-- callers who asked for a human (TWILIO_FORWARD_LIMIT admission control)
+CREATE TABLE human_forwards (
+    call INTEGER NOT NULL REFERENCES calls (id),
+    queued TIMESTAMP NOT NULL,
+    -- when the caller was admitted, and humans dialled; NULL while queued
+    started TIMESTAMP CHECK (started IS NULL OR started >= queued),
+    -- NULL while queued or dialling humans (or talking to one)
+    ended TIMESTAMP,
+
+    PRIMARY KEY (call)
+);
+
+CREATE INDEX human_forwards_open_index ON human_forwards (queued)
+    WHERE ended IS NULL;
+-- for queries:
+--   SELECT COUNT(*) FROM human_forwards WHERE ended IS NULL AND ...;
+--   SELECT call FROM human_forwards WHERE ended IS NULL AND
+--       started IS NULL ORDER BY queued LIMIT 1;
+
+CREATE TABLE call_reports (
+    call INTEGER NOT NULL REFERENCES calls (id),
+    ended TIMESTAMP NOT NULL,
+    caller VARCHAR(25) NOT NULL,
+    -- the call's log, formatted for email
+    summary TEXT NOT NULL,
+    -- emailed immediately, rather than in the next digest
+    urgent BOOLEAN NOT NULL,
+    -- NULL until claimed for sending (by a digest, or by the status
+    -- callback when emailing it at once)
+    emailed TIMESTAMP,
+
+    PRIMARY KEY (call)
+);
+
+CREATE INDEX call_reports_unsent_index ON call_reports (ended)
+    WHERE emailed IS NULL;
+-- for query:
+--   SELECT COUNT(*), MIN(ended) FROM call_reports WHERE emailed IS NULL;
+
+CREATE TABLE sms_log (
+    id SERIAL,
+    received TIMESTAMP NOT NULL,
+    sender VARCHAR(25) NOT NULL,
+    body VARCHAR(1600) NOT NULL,
+    -- NULL if the sender was rate limited
+    reply VARCHAR(500),
+
+    PRIMARY KEY (id)
+);
+
+-- each call's latest call log line, for the admin call board. Ended calls
+-- are kept for a while, so that late (journalled) lines can't revive them
+CREATE TABLE active_calls (
+    call INTEGER NOT NULL REFERENCES calls (id),
+    started TIMESTAMP NOT NULL,
+    updated TIMESTAMP NOT NULL,
+    stage VARCHAR(500) NOT NULL,
+    ended BOOLEAN NOT NULL DEFAULT FALSE,
+
+    PRIMARY KEY (call)
+);
+
+CREATE INDEX active_calls_open_index ON active_calls (started)
+    WHERE NOT ended;
+-- for query:
+--   SELECT ... FROM active_calls WHERE NOT ended AND ... ORDER BY started;
+
+-- responses to Twilio webhooks, replayed if Twilio retries them
+CREATE TABLE webhook_responses (
+    key CHAR(40) NOT NULL,
+    created TIMESTAMP NOT NULL,
+    response TEXT NOT NULL,
+
+    PRIMARY KEY (key)
+);
+
+CREATE INDEX webhook_responses_created_index ON webhook_responses (created);
+-- for query:
+--   DELETE FROM webhook_responses WHERE created < ...;
+
 CREATE TABLE messages (
     id SERIAL,
+    line INTEGER NOT NULL REFERENCES lines (id),
     short_name VARCHAR(40) NOT NULL CHECK (short_name != ''),
     web_short_text VARCHAR(500) NOT NULL CHECK (web_short_text != ''),
     web_long_text VARCHAR(2000) NOT NULL CHECK (web_long_text != ''),
     call_text VARCHAR(500) CHECK (call_text IS NULL OR call_text != ''),
-    forward_to INTEGER REFERENCES humans (id),
+    forward_to INTEGER,
     active_when TSRANGE DEFAULT NULL,
 
     PRIMARY KEY (id),
-    CONSTRAINT overlapping_range EXCLUDE USING gist (active_when WITH &&),
+    FOREIGN KEY (forward_to, line) REFERENCES humans (id, line),
+    CONSTRAINT overlapping_range
+        EXCLUDE USING gist (line WITH =, active_when WITH &&),
     CONSTRAINT active_when_finite
         CHECK (LOWER_INF(active_when) = FALSE AND
                UPPER_INF(active_when) = FALSE),
@@ -156,18 +347,84 @@ CREATE TRIGGER messages_past_delete_trigger
     ON messages
     FOR EACH ROW EXECUTE PROCEDURE messages_past_delete();
 
-CREATE INDEX messages_active_index ON messages USING gist (active_when);
+CREATE INDEX messages_active_index ON messages
+    USING gist (line, active_when);
+
+-- tell the app's workers to drop cached messages or humans (CACHE_NOTIFY)
+CREATE FUNCTION notify_cache()
+    RETURNS TRIGGER AS
+    $$
+        BEGIN
+            PERFORM pg_notify('notam_cache', TG_TABLE_NAME);
+            RETURN NULL;
+        END
+    $$
+    LANGUAGE plpgsql;
+
+CREATE TRIGGER messages_notify_cache_trigger
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+    ON messages
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_cache();
+
+CREATE TRIGGER humans_notify_cache_trigger
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+    ON humans
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_cache();
+
+CREATE TRIGGER lines_notify_cache_trigger
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+    ON lines
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_cache();
+
+CREATE TRIGGER humans_roster_notify_cache_trigger
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+    ON humans_roster
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_cache();
+
+CREATE TRIGGER human_availability_notify_cache_trigger
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+    ON human_availability
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_cache();
+
+-- push changes to the admin call board
+CREATE FUNCTION notify_call_board()
+    RETURNS TRIGGER AS
+    $$
+        BEGIN
+            PERFORM pg_notify('notam_calls', NEW.call::TEXT);
+            RETURN NULL;
+        END
+    $$
+    LANGUAGE plpgsql;
+
+CREATE TRIGGER active_calls_notify_call_board_trigger
+    AFTER INSERT OR UPDATE
+    ON active_calls
+    FOR EACH ROW EXECUTE PROCEDURE notify_call_board();
 
 -- allow adding to the call log
-GRANT SELECT, INSERT ON calls TO "www-data";
+GRANT SELECT, INSERT, UPDATE (line) ON calls TO "www-data";
 GRANT SELECT, UPDATE ON calls_id_seq TO "www-data";
 GRANT SELECT, INSERT ON call_log TO "www-data";
 GRANT SELECT, UPDATE ON call_log_id_seq TO "www-data";
+GRANT SELECT, INSERT, UPDATE ON human_dials TO "www-data";
+GRANT SELECT, UPDATE ON human_dials_id_seq TO "www-data";
+GRANT SELECT, INSERT, UPDATE (emailed) ON call_reports TO "www-data";
+GRANT SELECT, INSERT, UPDATE ON human_forwards TO "www-data";
+GRANT SELECT, INSERT, DELETE ON webhook_responses TO "www-data";
+GRANT SELECT, INSERT ON sms_log TO "www-data";
+GRANT SELECT, INSERT, UPDATE, DELETE ON active_calls TO "www-data";
+GRANT SELECT, UPDATE ON sms_log_id_seq TO "www-data";
+
+GRANT SELECT ON lines TO "www-data";
 
 -- allow adding humans and modifying existing humans' priorities
 GRANT SELECT, INSERT ON humans TO "www-data";
 GRANT SELECT, UPDATE ON humans_id_seq TO "www-data";
 GRANT UPDATE (priority) ON humans TO "www-data";
+GRANT SELECT, UPDATE ON humans_roster TO "www-data";
+GRANT SELECT, INSERT, DELETE ON human_availability TO "www-data";
+GRANT SELECT, UPDATE ON human_availability_id_seq TO "www-data";
 
 -- allow adding and updating messages. Triggers protect the past
 GRANT SELECT, INSERT, UPDATE, DELETE ON messages TO "www-data";
@@ -0,0 +1,73 @@
+// Keeps the call board (templates/call_board.html) up to date, from the
+// server-sent events of notam.call_board_stream
+$(function () {
+    var table = $("#calls");
+    var tbody = table.find("tbody");
+    var empty = tbody.find("tr.empty");
+    // call id -> Date.now() when the call started, by our clock
+    var started = {};
+
+    function formatElapsed(ms) {
+        var seconds = Math.max(0, Math.floor(ms / 1000));
+        var s = seconds % 60;
+        return Math.floor(seconds / 60) + ":" + (s < 10 ? "0" : "") + s;
+    }
+
+    function tick() {
+        var now = Date.now();
+        tbody.find("tr[data-call]").each(function () {
+            var row = $(this);
+            row.find(".elapsed").text(formatElapsed(now - started[row.data("call")]));
+        });
+        empty.toggleClass("hide", tbody.find("tr[data-call]").length > 0);
+    }
+
+    function update(call) {
+        var row = tbody.find("tr[data-call=" + call.call + "]");
+
+        if (call.ended) {
+            row.remove();
+            delete started[call.call];
+            return;
+        }
+
+        if (!row.length) {
+            var link = $("<a class='btn btn-small btn-block'>View log</a>")
+                .attr("href", table.data("log-viewer-call") + call.call);
+            row = $("<tr>").attr("data-call", call.call).append(
+                $("<td class='call_id'>").text(call.call),
+                $("<td class='elapsed'>"),
+                $("<td class='stage'>"),
+                $("<td class='ringing'>"),
+                $("<td>").append(link));
+            empty.before(row);
+        }
+
+        started[call.call] = Date.now() - call.elapsed * 1000;
+        row.find(".stage").text(call.stage);
+        row.find(".ringing").text(call.ringing.join(", "));
+    }
+
+    tbody.find("tr[data-call]").each(function () {
+        var row = $(this);
+        started[row.data("call")] = Date.now() - row.data("elapsed") * 1000;
+    });
+    setInterval(tick, 1000);
+
+    if (!window.EventSource) {
+        return;
+    }
+
+    // the stream ends every few minutes, and EventSource reconnects
+    var source = new EventSource(table.data("stream"));
+    source.addEventListener("calls", function (e) {
+        tbody.find("tr[data-call]").remove();
+        started = {};
+        $.each(JSON.parse(e.data), function (i, call) { update(call); });
+        tick();
+    });
+    source.addEventListener("call", function (e) {
+        update(JSON.parse(e.data));
+        tick();
+    });
+});
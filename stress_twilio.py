@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Check a deployment under concurrent Twilio traffic
+
+Simulates many calls at once against a running instance (e.g., uWSGI with
+threads or gevent; see notam.make_psycopg2_green), each signed with the
+Twilio auth token as Twilio would:
+
+ - POST /twilio/call/start
+ - POST /twilio/call/gathered, pressing 1 (hang up)
+ - the same again, as if Twilio had retried it
+
+and then checks, in PostgreSQL, that every call has exactly its own
+three call log lines, in order, and that each retry got the original
+response. Calls use CallSids starting CAstress, and From numbers that
+shouldn't belong to anyone; --cleanup deletes them afterwards (which needs
+a DSN allowed to DELETE from calls and the tables referring to it:
+call_log, active_calls, human_dials, human_forwards and call_reports).
+
+Don't point this at production during a launch: every call is real work.
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+
+try:
+    from urllib.request import urlopen, Request
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib2 import urlopen, Request
+    from urllib import urlencode
+
+import psycopg2
+import twilio.util
+
+class Failure(Exception):
+    pass
+
+class Caller(object):
+    def __init__(self, args):
+        self.args = args
+        self.validator = twilio.util.RequestValidator(args.auth_token)
+
+    def post(self, path, params):
+        """POST params to path, signed; returns (seconds, body)"""
+
+        url = self.args.url.rstrip("/") + path
+        signature = self.validator.compute_signature(url, params)
+        request = Request(url, urlencode(params).encode("ascii"),
+                          {"X-Twilio-Signature": signature})
+
+        start = time.time()
+        response = urlopen(request, timeout=self.args.timeout)
+        body = response.read()
+        if response.getcode() != 200:
+            raise Failure("{0}: HTTP {1}".format(path, response.getcode()))
+        return time.time() - start, body
+
+    def call(self, sid, number):
+        """Make one call; returns the request latencies"""
+
+        common = {"CallSid": sid, "From": number, "To": self.args.to}
+        latencies = []
+
+        seconds, body = self.post("/twilio/call/start", common)
+        latencies.append(seconds)
+        if b"Gather" not in body and b"Dial" not in body:
+            raise Failure("{0}: unexpected start response".format(sid))
+
+        gathered = dict(common, Digits="1")
+        seconds, first = self.post("/twilio/call/gathered", gathered)
+        latencies.append(seconds)
+        seconds, retry = self.post("/twilio/call/gathered", gathered)
+        latencies.append(seconds)
+        if first != retry:
+            raise Failure("{0}: retry got a different response".format(sid))
+
+        return latencies
+
+def expected_lines(number):
+    return ("Call started; from {0}".format(number), None,
+            "Hanging up (pressed 1)")
+
+def check_call_log(conn, calls, wait):
+    """Check each call's log (waiting up to wait seconds for journals)"""
+
+    query = "SELECT c.sid, l.message FROM call_log AS l " \
+            "JOIN calls AS c ON c.id = l.call " \
+            "WHERE c.sid = ANY(%s) ORDER BY c.sid, l.time, l.id"
+
+    deadline = time.time() + wait
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(query, ([sid for sid, number in calls], ))
+            rows = cur.fetchall()
+        conn.rollback()
+
+        logs = {}
+        for sid, message in rows:
+            if isinstance(message, bytes):
+                message = message.decode("ascii")
+            logs.setdefault(sid, []).append(message)
+
+        problems = []
+        for sid, number in calls:
+            lines = logs.get(sid, [])
+            expected = expected_lines(number)
+            if len(lines) != len(expected) or \
+                    any(e is not None and e != l
+                        for e, l in zip(expected, lines)):
+                problems.append("{0}: {1!r}".format(sid, lines))
+
+        if not problems or time.time() > deadline:
+            return problems
+        time.sleep(1)
+
+# tables with foreign keys to calls, deleted from first
+call_tables = ("call_log", "active_calls", "human_dials", "human_forwards",
+               "call_reports")
+
+def cleanup(conn, calls):
+    sids = [sid for sid, number in calls]
+    with conn.cursor() as cur:
+        for table in call_tables:
+            cur.execute("DELETE FROM {0} WHERE call IN "
+                        "(SELECT id FROM calls WHERE sid = ANY(%s))"
+                        .format(table), (sids, ))
+        cur.execute("DELETE FROM calls WHERE sid = ANY(%s)", (sids, ))
+    conn.commit()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("url", help="base URL, as Twilio sees it")
+    parser.add_argument("dsn", help="PostgreSQL DSN, to check the call log")
+    parser.add_argument("--auth-token", required=True)
+    parser.add_argument("--to", default="+441223000000",
+                        help="the number being called")
+    parser.add_argument("-n", "--calls", type=int, default=200)
+    parser.add_argument("-c", "--concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=15,
+                        help="per request, as Twilio's")
+    parser.add_argument("--wait", type=float, default=10,
+                        help="for journalled call log lines to arrive")
+    parser.add_argument("--cleanup", action="store_true")
+    args = parser.parse_args(argv)
+
+    run = random.getrandbits(24)
+    calls = [("CAstress{0:06x}{1:06d}".format(run, i),
+              "+9990{0:06d}".format(i))
+             for i in range(args.calls)]
+
+    caller = Caller(args)
+    pending = list(reversed(calls))
+    lock = threading.Lock()
+    latencies = []
+    failures = []
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                sid, number = pending.pop()
+            try:
+                result = caller.call(sid, number)
+            except Exception as e:
+                with lock:
+                    failures.append("{0}: {1}".format(sid, e))
+            else:
+                with lock:
+                    latencies.extend(result)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker)
+               for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    print("{0} calls ({1} requests) in {2:.1f}s, {3} at once"
+          .format(args.calls, len(latencies), elapsed, args.concurrency))
+    if latencies:
+        print("latency: median {0:.3f}s, 95% {1:.3f}s, max {2:.3f}s"
+              .format(percentile(latencies, 0.5),
+                      percentile(latencies, 0.95), max(latencies)))
+
+    conn = psycopg2.connect(args.dsn)
+    problems = check_call_log(conn, calls, args.wait)
+    if args.cleanup:
+        cleanup(conn, calls)
+    conn.close()
+
+    for line in failures + problems:
+        print(line)
+    if failures or problems:
+        sys.exit("FAILED: {0} request failures, {1} bad call logs"
+                 .format(len(failures), len(problems)))
+    print("OK")
+
+if __name__ == "__main__":
+    main()
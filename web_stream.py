@@ -0,0 +1,12 @@
+"""
+uWSGI mule that serves /web/stream (Server-Sent Events) on WEB_STREAM_SOCKET
+
+The mule is forked from the uWSGI master after notam.wsgi has configured
+the app, so importing notam here gets the configured app. Point the web
+server at WEB_STREAM_SOCKET for /web/stream, with buffering off.
+"""
+
+from notam import app, run_web_stream
+
+if app.config.get("WEB_STREAM_SOCKET"):
+    run_web_stream()
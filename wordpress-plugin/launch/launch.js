@@ -3,17 +3,51 @@ jQuery(function() {
     var short = jQuery(".cusf-notam-info-short");
     var long = jQuery(".cusf-notam-info-long");
 
-    if (short.length !== 0 || long.length !== 0) {
+    if (short.length === 0 && long.length === 0) {
+        return;
+    }
+
+    function show(data) {
+        short.text(data.short);
+        long.text(data.long);
+    }
+
+    function poll() {
         jQuery.ajax({
             url: "/notam-ajax/web.json",
             dataType: "json",
         }).always(function () {
             short.text("Unknown")
             long.text("Unknown")
-        }).done(function (data) {
-            short.text(data.short);
-            long.text(data.long);
-        });
+        }).done(show);
+    }
+
+    if (!window.EventSource) {
+        poll();
+        return;
     }
 
+    // web/stream sends the texts, and again whenever they change. If it
+    // isn't working, fall back to a single fetch of web.json
+    var stream = new EventSource("/notam-ajax/web/stream");
+    var received = false;
+
+    function fallback() {
+        if (!received) {
+            stream.close();
+            poll();
+        }
+    }
+
+    var timeout = setTimeout(fallback, 10000);
+
+    stream.onmessage = function (e) {
+        received = true;
+        clearTimeout(timeout);
+        show(JSON.parse(e.data));
+    };
+
+    // after the first message, let EventSource reconnect by itself
+    stream.onerror = fallback;
+
 });